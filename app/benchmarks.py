@@ -0,0 +1,79 @@
+from django.contrib.auth.models import User
+
+from app.models import Category, Chat, Comment, Message, Order
+from app.serializers import (
+    OrderChatListSerializer,
+    MessageListSerializer,
+    OrderListSerializer,
+    ChatListSerializer,
+)
+from core.prefetch import plan_for
+
+
+class Rollback(Exception):
+    """
+    Raised at the end of a transaction.atomic() block to throw the seeded rows away
+    """
+
+
+PAGE_SIZE = 10
+
+# list endpoints covered by the query budgets, ids come from seed_page
+ENDPOINTS = (
+    '/api/orders/',
+    '/api/orders/?before=',
+    '/api/orders/?facets=1&ordering=price',
+    '/api/orders/{order}/',
+    '/api/user/orders/',
+    '/api/user/orders/?before=',
+    '/api/chats/',
+    '/api/chats/{chat}/messages/',
+    '/api/chats/{chat}/messages/?before=',
+    '/api/comments/',
+    '/api/comments/{commented}/user/',
+    '/api/comments/{commented}/user/?before=',
+    '/api/categories/',
+    '/api/authors/',
+)
+
+
+def seed_page(page_size=PAGE_SIZE):
+    """
+    A page worth of rows for every list endpoint, seen by the returned user
+    """
+
+    users = [User.objects.create(username='seed_page_%s' % index) for index in range(page_size + 1)]
+    user = users[0]
+    categories = [Category.objects.create(name='Category %s' % index) for index in range(page_size)]
+    orders = [
+        Order.objects.create(title='Order %s' % index, description='Description', author=author, price=index,
+                             category=category)
+        for index, (author, category) in enumerate(zip(users[1:], categories))
+    ]
+    orders += [
+        Order.objects.create(title='Own order', description='Description', author=user, price=1, category=category)
+        for category in categories
+    ]
+    chats = [Chat.objects.create(order=order, producer=order.author, consumer=user) for order in orders[:page_size]]
+    for sender in users[1:]:
+        Message.objects.create(chat=chats[0], sender=sender, text='Text', message_type=Message.MessageTypes.TEXT.value)
+        Comment.objects.create(user=users[1], author=sender, message='Comment')
+    return user, {'order': orders[0].pk, 'chat': chats[0].pk, 'commented': users[1].pk}
+
+
+def serializer_querysets(user, chat_id):
+    """
+    The hot list serializers with the querysets their endpoints serialize, planned like the views plan them
+    """
+
+    newest = ('-created_at', '-id')
+    return [
+        (serializer_class, plan_for(serializer_class).apply(queryset))
+        for serializer_class, queryset in (
+            (OrderChatListSerializer, Order.objects.filter(is_active=True).with_viewer_chat(user).order_by(*newest)),
+            (OrderListSerializer, Order.objects.filter(author=user).order_by(*newest)),
+            (ChatListSerializer, Chat.objects.for_member(user).with_viewer_state(user).order_by(
+                '-last_activity_at', '-id')),
+            (MessageListSerializer, Message.objects.filter(chat_id=chat_id).order_by(*newest)),
+        )
+    ]
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, When
+
+
+def price_buckets():
+    """
+    (min, max) bounds of the configured price buckets, max is exclusive and None for the last one
+    """
+
+    bounds = [0, *settings.ORDER_PRICE_BUCKETS]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def order_facets(queryset):
+    """
+    Order counts per category and per price bucket of a filtered queryset
+    Both come from one query grouped by (category, bucket), the
+    (is_active, category, price) index covers the columns read from orders
+    """
+
+    buckets = price_buckets()
+    bucket = Case(
+        *(When(price__lt=upper, then=index) for index, (_, upper) in enumerate(buckets[:-1])),
+        default=len(buckets) - 1,
+        output_field=IntegerField(),
+    )
+    # selected by pk, annotations of the queryset would otherwise be computed and grouped by
+    queryset = queryset.model._base_manager.filter(pk__in=queryset.order_by().values('pk'))
+    rows = queryset.annotate(bucket=bucket).values('category', 'category__name', 'bucket').annotate(
+        count=Count('pk'))
+
+    categories = {}
+    price_counts = [0] * len(buckets)
+    for row in rows:
+        category = categories.setdefault(
+            row['category'], {'id': row['category'], 'name': row['category__name'], 'count': 0})
+        category['count'] += row['count']
+        price_counts[row['bucket']] += row['count']
+
+    return {
+        'categories': sorted(categories.values(), key=lambda category: (-category['count'], category['id'])),
+        'price': [
+            {'min': lower, 'max': upper, 'count': count}
+            for (lower, upper), count in zip(buckets, price_counts)
+        ],
+    }
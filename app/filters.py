@@ -1,16 +1,41 @@
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import BaseFilterBackend
+from rest_framework.settings import api_settings
+
+from app.search import parse_terms, search_orders
 
 
 class OrderPriceFilter(BaseFilterBackend):
+    """
+    ?min_price= and ?max_price= bounds, the ordering is left to OrderingFilter
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for param, lookup in (('min_price', 'price__gte'), ('max_price', 'price__lte')):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                queryset = queryset.filter(**{lookup: int(value)})
+            except ValueError:
+                raise ValidationError({param: ['A valid integer is required.']})
+        return queryset
+
+
+class OrderSearchFilter(BaseFilterBackend):
+    """
+    Full-text prefix search over title, description and category name
+    Results are ranked unless the client asked for an explicit ordering
+    """
+
+    search_param = api_settings.SEARCH_PARAM
+    ordering_param = api_settings.ORDERING_PARAM
 
     def filter_queryset(self, request, queryset, view):
-        min_price = request.query_params.get('min_price', None)
-        max_price = request.query_params.get('max_price', None)
-        try:
-            if min_price:
-                queryset = queryset.filter(price__gte=int(min_price))
-            if max_price:
-                queryset = queryset.filter(price__lte=int(max_price))
-        except Exception:
-            return queryset.order_by('-created_at')
-        return queryset.order_by('-created_at')
+        terms = parse_terms(request.query_params.get(self.search_param))
+        if not terms:
+            return queryset
+        queryset = search_orders(queryset, terms)
+        if self.ordering_param in request.query_params:
+            return queryset
+        return queryset.order_by('-search_rank', '-created_at', '-id')
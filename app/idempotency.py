@@ -0,0 +1,122 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from app.models import IdempotencyKey
+
+
+def key_digest(scope: str, key: str) -> str:
+    """
+    Keys are stored as a fixed size digest, clients may send keys of any length
+    """
+
+    return hashlib.sha256(('%s:%s' % (scope, key)).encode()).hexdigest()
+
+
+def expires_at():
+    return timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+
+def request_fingerprint(request) -> str:
+    """
+    Digest of what a request asks for, uploads are described by name and size
+    so they do not have to be read again
+    """
+
+    data = request.data
+    fields = data.lists() if hasattr(data, 'lists') else ((field, [value]) for field, value in data.items())
+    described = sorted(
+        (field, [[value.name, value.size] if isinstance(value, UploadedFile) else value for value in values])
+        for field, values in fields
+    )
+    payload = json.dumps([request.method, request.get_full_path(), described], default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def claim(user_id, key: str, fingerprint: str = ''):
+    """
+    Reserve a key for the request about to run
+    Returns the row and whether it was claimed, an expired row is taken over
+    """
+
+    while True:
+        record = IdempotencyKey(user_id=user_id, key=key, fingerprint=fingerprint, expires_at=expires_at())
+        try:
+            with transaction.atomic():
+                record.save(force_insert=True)
+            return record, True
+        except IntegrityError:
+            pass
+
+        existing = IdempotencyKey.objects.filter(user_id=user_id, key=key).first()
+        if existing is None:
+            # released by a failed attempt or purged since the insert, the key is free again
+            continue
+        taken_over = IdempotencyKey.objects.filter(pk=existing.pk, expires_at__lte=timezone.now()).update(
+            fingerprint=fingerprint, status_code=None, response=None, expires_at=record.expires_at)
+        if taken_over:
+            record.pk = existing.pk
+            return record, True
+        return existing, False
+
+
+def replayed(user_id, key: str):
+    """
+    Stored outcome of a completed request, None when there is nothing to replay
+    """
+
+    return IdempotencyKey.objects.filter(
+        user_id=user_id, key=key, status_code__isnull=False, expires_at__gt=timezone.now()
+    ).first()
+
+
+def idempotent(view_method):
+    """
+    Replays the stored response of a request retried with the same Idempotency-Key header
+    The view runs until it succeeds once per key, an attempt failing with an error response (4xx or 5xx,
+    returned or raised) releases the key, so the retry is handled like a new request
+    """
+
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        header = request.headers.get('Idempotency-Key')
+        if not header:
+            return view_method(self, request, *args, **kwargs)
+
+        fingerprint = request_fingerprint(request)
+        record, claimed = claim(request.user.pk, key_digest('http', header), fingerprint)
+        if not claimed:
+            if record.fingerprint != fingerprint:
+                return Response(
+                    {'detail': 'Idempotency-Key was already used for a different request.'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if record.status_code is None:
+                return Response(
+                    {'detail': 'A request with this Idempotency-Key is still in progress.'},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            response = Response(record.response, status=record.status_code)
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        if response.status_code >= 400:
+            record.delete()
+        else:
+            IdempotencyKey.objects.filter(pk=record.pk).update(status_code=response.status_code, response=response.data)
+        return response
+
+    return wrapper
@@ -0,0 +1,204 @@
+import logging
+import os
+import posixpath
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+from multiprocessing import get_context
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+
+from app.models import Blob, Image, Order
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+class InlineExecutor(Executor):
+    """
+    Runs tasks in the calling thread, a stand-in for the process pool in tests
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+def _setup_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        config = settings.IMAGE_PIPELINE
+        if config['EXECUTOR'] == 'inline':
+            _executor = InlineExecutor()
+        else:
+            # spawned workers do not inherit the parent's database connections
+            _executor = ProcessPoolExecutor(
+                max_workers=config['WORKERS'],
+                mp_context=get_context('spawn'),
+                initializer=_setup_worker,
+                initargs=(os.environ['DJANGO_SETTINGS_MODULE'],),
+            )
+    return _executor
+
+
+def store_images(order: Order, uploads: Iterable, position: int = 0) -> List[Image]:
+    """
+    Stream uploads to storage chunk by chunk, insert their rows at once
+    and render the variants in the background after commit
+    Content that is already stored reuses the blob and the variants rendered for it
+    """
+
+    field = Image._meta.get_field('file')
+    images = [
+        Image(
+            order=order,
+            file=field.storage.save(field.generate_filename(None, upload.name), upload),
+            position=position + index,
+        )
+        for index, upload in enumerate(uploads)
+    ]
+    if not images:
+        return images
+    rendered = dict(
+        Image.objects.filter(file__in=[image.file.name for image in images])
+        .exclude(variants={})
+        .values_list('file', 'variants')
+    )
+    for image in images:
+        image.variants = rendered.get(image.file.name, {})
+    Image.objects.bulk_create(images)
+    Blob.objects.acquire(name for image in images for name in image.stored_names())
+
+    pending = {image.file.name for image in images if not image.variants}
+    transaction.on_commit(lambda: schedule_variants(pending))
+    return images
+
+
+def update_images(order: Order, keep_ids: Optional[List[int]], uploads: Iterable) -> List[Image]:
+    """
+    Apply an image edit as one diff with a constant number of queries
+    Images missing from keep_ids are deleted, kept ones are ordered as in keep_ids
+    and uploads are appended after them, keep_ids=None keeps the current images
+    Files nobody references any more are removed after commit by collect_blobs
+    """
+
+    current = {
+        pk: (position, [name, *variants.values()])
+        for pk, position, name, variants in Image.objects.filter(order=order).values_list(
+            'id', 'position', 'file', 'variants')
+    }
+    if keep_ids is None:
+        keep_ids = sorted(current, key=lambda pk: (current[pk][0], pk))
+    keep_ids = [pk for pk in dict.fromkeys(keep_ids) if pk in current]
+
+    deleted = current.keys() - set(keep_ids)
+    if deleted:
+        # nothing references images, the delete collector and its per-row signals can be skipped
+        queryset = Image.objects.filter(pk__in=deleted)
+        queryset._raw_delete(queryset.db)
+        release_blobs([name for pk in deleted for name in current[pk][1]], using=queryset.db)
+
+    moved = [Image(pk=pk, position=position) for position, pk in enumerate(keep_ids) if current[pk][0] != position]
+    if moved:
+        Image.objects.bulk_update(moved, ['position'])
+
+    return store_images(order, uploads, position=len(keep_ids))
+
+
+def schedule_variants(names: Iterable[str]):
+    executor = get_executor()
+    for name in names:
+        executor.submit(render_variants, name).add_done_callback(_log_failure)
+
+
+def render_variants(name: str) -> dict:
+    """
+    Render a downscaled WebP copy of a stored image for each configured variant
+    Files that are not images are left without variants
+    """
+
+    from PIL import Image as Picture, UnidentifiedImageError
+
+    config = settings.IMAGE_PIPELINE
+    storage = Image._meta.get_field('file').storage
+    root = posixpath.splitext(name)[0]
+    variants = {}
+    with storage.open(name) as source:
+        try:
+            picture = Picture.open(source)
+            picture.draft('RGB', max(config['VARIANTS'].values()))
+            picture = picture.convert('RGBA' if 'A' in picture.getbands() else 'RGB')
+        except (UnidentifiedImageError, OSError):
+            return variants
+        for variant, size in config['VARIANTS'].items():
+            resized = picture.copy()
+            resized.thumbnail(size)
+            buffer = BytesIO()
+            resized.save(buffer, 'WEBP', quality=config['QUALITY'])
+            variants[variant] = storage.save('%s.%s.webp' % (root, variant), ContentFile(buffer.getvalue()))
+    with transaction.atomic():
+        images = Image.objects.filter(file=name, variants={})
+        # order details render their images, the ETags stamped from updated_at have to change with them
+        Order.objects.filter(pk__in=images.values('order_id')).update(updated_at=timezone.now())
+        rows = images.update(variants=variants)
+        Blob.objects.acquire(list(variants.values()) * rows)
+    return variants
+
+
+def release_blobs(names: List[str], using: str = 'default'):
+    """
+    Drop one reference per name and collect the blobs left without any once the release is committed
+    """
+
+    Blob.objects.release(names)
+    transaction.on_commit(lambda: collect_blobs(names), using=using)
+
+
+def collect_blobs(names: Iterable[str]) -> int:
+    """
+    Delete released blobs nobody references any more together with their files,
+    run once the release is committed
+    Files touched within MEDIA_GARBAGE_GRACE_MINUTES are left to collect_media_garbage,
+    an upload may be reusing their content
+    """
+
+    storage = Image._meta.get_field('file').storage
+    cutoff = timezone.now() - timedelta(minutes=settings.MEDIA_GARBAGE_GRACE_MINUTES)
+    collected = []
+    with transaction.atomic():
+        # locked until the delete commits, an upload acquiring one of them waits for it
+        released = Blob.objects.select_for_update().filter(name__in=set(names), references__lte=0)
+        for name in released.values_list('name', flat=True):
+            try:
+                if not storage.exists(name) or storage.get_modified_time(name) < cutoff:
+                    collected.append(name)
+            except OSError:
+                logger.exception('Failed to check stored file %s', name)
+        if collected:
+            Blob.objects.filter(name__in=collected).delete()
+    for name in collected:
+        try:
+            storage.delete(name)
+        except OSError:
+            logger.exception('Failed to delete stored file %s', name)
+    return len(collected)
+
+
+def _log_failure(future: Future):
+    if future.exception() is not None:
+        logger.error('Failed to render image variants', exc_info=future.exception())
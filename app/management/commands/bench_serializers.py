@@ -0,0 +1,101 @@
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from app.benchmarks import Rollback, serializer_querysets
+from app.models import Category, Chat, Message, Order
+from core.compiled import compiled_for
+from core.renderers import FastJSONRenderer
+
+
+class Command(BaseCommand):
+    help = 'Seeds rows for the hot list serializers and compares DRF and compiled rendering in rows per second'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help='Orders and messages seeded')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per serializer, the fastest one is reported')
+        parser.add_argument(
+            '--min-speedup', type=float, default=1.0,
+            help='Fail when a compiled serializer is not this many times faster',
+        )
+
+    def handle(self, *args, **options):
+        results = []
+        try:
+            with transaction.atomic():
+                user, chat_id = self.seed(options['rows'])
+                for serializer_class, queryset in serializer_querysets(user, chat_id):
+                    drf = self.measure(options['repeat'], lambda: JSONRenderer().render(
+                        serializer_class(queryset.all(), many=True).data))
+                    compiled = compiled_for(serializer_class)
+                    fast = self.measure(options['repeat'], lambda: FastJSONRenderer().render(
+                        compiled.serialize(compiled.project(queryset.all()))))
+                    results.append((serializer_class.__name__, queryset.count(), drf, fast))
+                raise Rollback
+        except Rollback:
+            pass
+
+        failures = []
+        for name, rows, drf, fast in results:
+            speedup = drf / fast
+            self.stdout.write('%s: %s rows, DRF %.0f rows/s, compiled %.0f rows/s, %.1fx' % (
+                name, rows, rows / drf, rows / fast, speedup))
+            if speedup < options['min_speedup']:
+                failures.append('%s is %.1fx faster compiled, expected %.1fx' % (name, speedup, options['min_speedup']))
+        if failures:
+            raise CommandError('\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('Compiled serializers are within the speedup budget'))
+
+    @staticmethod
+    def measure(repeat, render):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            render()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    def seed(self, rows):
+        """
+        Half of the orders are the user's own, the user chats about each of the others
+        and all messages go to one chat
+        """
+
+        # unique names keep the seeded users clear of existing ones, they are rolled back anyway
+        prefix = 'bench_serializers_%s' % uuid.uuid4().hex[:8]
+        user = User.objects.create(username=prefix, first_name='Bench', last_name='User')
+        others = [
+            User.objects.create(username='%s_%s' % (prefix, index), first_name='First', last_name='Last')
+            for index in range(100)
+        ]
+        category = Category.objects.create(name='Bench category')
+        Order.objects.bulk_create(
+            Order(
+                title='Order %s' % index,
+                description='Description %s' % index,
+                author=others[index % len(others)] if index % 2 else user,
+                price=index,
+                category=category,
+            )
+            for index in range(rows)
+        )
+        Chat.objects.bulk_create(
+            Chat(order=order, producer_id=order.author_id, consumer=user)
+            for order in Order.objects.filter(category=category).exclude(author=user)
+        )
+        chat = Chat.objects.filter(consumer=user).select_related('producer').first()
+        Message.objects.bulk_create(
+            Message(
+                chat=chat,
+                sender=chat.producer if index % 2 else user,
+                text='Message %s' % index,
+                message_type=Message.MessageTypes.TEXT.value,
+            )
+            for index in range(rows)
+        )
+        Chat.objects.record_messages(Message.objects.filter(chat=chat))
+        return user, chat.pk
@@ -0,0 +1,65 @@
+import statistics
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIClient
+
+from app.benchmarks import Rollback
+from app.models import Comment
+
+
+class Command(BaseCommand):
+    help = 'Seeds comments about one user and fails if paging through them exceeds a response time budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--comments', type=int, default=100000)
+        parser.add_argument('--authors', type=int, default=100, help='Users the comments are spread across')
+        parser.add_argument('--pages', type=int, default=50, help='Pages walked with ?before= cursors')
+        parser.add_argument('--max-ms', type=float, default=100, help='Budget for the p95 response time')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                user = self.seed(options['comments'], options['authors'])
+                timings = self.walk(user, options['pages'])
+                raise Rollback
+        except Rollback:
+            pass
+
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        self.stdout.write('%s pages, p50 %.2f ms, p95 %.2f ms, max %.2f ms' % (
+            len(timings), statistics.median(timings), p95, max(timings)))
+        if p95 > options['max_ms']:
+            raise CommandError('p95 %.2f ms is over the %.2f ms budget' % (p95, options['max_ms']))
+        self.stdout.write(self.style.SUCCESS('Comments of a user are within the response time budget'))
+
+    def seed(self, comments, authors):
+        # unique names keep the seeded users clear of existing ones, they are rolled back anyway
+        prefix = 'bench_comments_%s' % uuid.uuid4().hex[:8]
+        user = User.objects.create(username=prefix)
+        writers = [User.objects.create(username='%s_%s' % (prefix, index)) for index in range(authors)]
+        batch = []
+        for index in range(comments):
+            batch.append(Comment(user=user, author=writers[index % authors], message='Comment %s' % index))
+            if len(batch) == 5000:
+                Comment.objects.bulk_create(batch)
+                batch = []
+        Comment.objects.bulk_create(batch)
+        return user
+
+    def walk(self, user, pages):
+        client = APIClient()
+        client.force_authenticate(user)
+        url = '/api/comments/%s/user/?before=' % user.pk
+        timings = []
+        while url and len(timings) < pages:
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise CommandError('%s returned %s' % (url, response.status_code))
+            url = response.data['next']
+        return timings
@@ -0,0 +1,56 @@
+import posixpath
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.models import Blob, Image
+
+
+class Command(BaseCommand):
+    help = 'Deletes blobs of the content-addressed storage that no Image row references any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+        parser.add_argument(
+            '--grace-minutes', type=int, default=settings.MEDIA_GARBAGE_GRACE_MINUTES,
+            help='Files touched more recently than this are kept, they may belong to uploads in flight',
+        )
+
+    def handle(self, *args, **options):
+        self.storage = Image._meta.get_field('file').storage
+        self.dry_run = options['dry_run']
+        self.cutoff = timezone.now() - timedelta(minutes=options['grace_minutes'])
+
+        released = 0
+        for blob in Blob.objects.filter(references__lte=0, updated_at__lt=self.cutoff).iterator():
+            if self.dry_run or Blob.objects.filter(pk=blob.pk, references__lte=0).delete()[0]:
+                released += self.delete(blob.name)
+
+        known = set(Blob.objects.values_list('name', flat=True))
+        # other directories of MEDIA_ROOT hold temporary files of uploads in flight and files of other storages
+        orphaned = 0
+        if self.storage.exists(self.storage.blob_directory):
+            orphaned = sum(self.delete(name) for name in self.walk(self.storage.blob_directory) if name not in known)
+
+        self.stdout.write(self.style.SUCCESS(
+            '%s %s unreferenced and %s orphaned files' % (
+                'Would delete' if self.dry_run else 'Deleted', released, orphaned)
+        ))
+
+    def walk(self, directory):
+        directories, files = self.storage.listdir(directory)
+        for name in files:
+            yield posixpath.join(directory, name)
+        for name in directories:
+            yield from self.walk(posixpath.join(directory, name))
+
+    def delete(self, name):
+        if not self.storage.exists(name) or self.storage.get_modified_time(name) >= self.cutoff:
+            return 0
+        if self.dry_run:
+            self.stdout.write('Would delete %s' % name)
+        else:
+            self.storage.delete(name)
+        return 1
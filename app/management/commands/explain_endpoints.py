@@ -0,0 +1,93 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from app.benchmarks import ENDPOINTS, Rollback, seed_page
+from app.models import Chat, Comment, Order
+from core.cache import invalidate
+
+# plan lines reading a whole table: PostgreSQL 'Seq Scan on x', SQLite 'SCAN x' without an index
+SEQ_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN ANALYZE over the SQL of the endpoints with query budgets and reports plans with sequential scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--existing-data', action='store_true',
+            help='Explain against the rows already in the database instead of seeded ones',
+        )
+        parser.add_argument('--fail', action='store_true', help='Exit with an error when a seq scan is found')
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in SEQ_SCAN:
+            raise CommandError('EXPLAIN is not supported on %s' % vendor)
+
+        reports = []
+        try:
+            with transaction.atomic():
+                client = APIClient()
+                if options['existing_data']:
+                    user, ids = self.existing()
+                else:
+                    user, ids = seed_page()
+                    if vendor == 'postgresql':
+                        # a handful of seeded rows is cheaper to scan, ask whether an index could be used at all
+                        with connection.cursor() as cursor:
+                            cursor.execute('SET LOCAL enable_seqscan = off')
+                client.force_authenticate(user)
+                for url in ENDPOINTS:
+                    url = url.format(**ids)
+                    with CaptureQueriesContext(connection) as queries:
+                        client.get(url)
+                    for query in queries.captured_queries:
+                        if query['sql'].lstrip().upper().startswith('SELECT'):
+                            reports.append((url, query['sql'], self.explain(vendor, query['sql'])))
+                raise Rollback
+        except Rollback:
+            invalidate('categories')
+            invalidate('authors', 'list')
+
+        scans = 0
+        for url, sql, plan in reports:
+            matches = (SEQ_SCAN[vendor].search(line.strip()) for line in plan)
+            tables = sorted({match.group(1) for match in matches if match})
+            if not tables:
+                continue
+            scans += 1
+            self.stdout.write(self.style.WARNING('%s scans %s' % (url, ', '.join(tables))))
+            self.stdout.write('  %s' % sql)
+            for line in plan:
+                self.stdout.write('    %s' % line)
+
+        summary = '%s of %s queries fall back to sequential scans' % (scans, len(reports))
+        if scans and options['fail']:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary) if not scans else summary)
+
+    @staticmethod
+    def explain(vendor, sql):
+        with connection.cursor() as cursor:
+            if vendor == 'postgresql':
+                cursor.execute('EXPLAIN ANALYZE %s' % sql)
+                return [row[0] for row in cursor.fetchall()]
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    @staticmethod
+    def existing():
+        chat = Chat.objects.order_by('-last_activity_at').first()
+        if chat is None:
+            raise CommandError('--existing-data needs at least one chat')
+        user = chat.consumer
+        order = Order.objects.filter(is_active=True).order_by('-created_at').first() or chat.order
+        commented = Comment.objects.values_list('user', flat=True).first() or user.pk
+        return user, {'order': order.pk, 'chat': chat.pk, 'commented': commented}
@@ -0,0 +1,43 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Chat
+from app.transcripts import gzip_chunks, transcript_chunks, transcript_messages
+
+
+class Command(BaseCommand):
+    help = 'Streams the messages of chats as NDJSON or JSON, for archives and compliance exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, action='append', default=[], help='Chat id, can be repeated')
+        parser.add_argument('--user', type=int, help='Export every chat the user takes part in')
+        parser.add_argument('--output', choices=('ndjson', 'json'), default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help='Compress the transcript on the fly')
+        parser.add_argument('--file', help='Write to this path instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['user'] is not None:
+            chat_ids = Chat.objects.for_member(options['user']).values('id')
+        elif options['chat']:
+            chat_ids = options['chat']
+        else:
+            raise CommandError('Pass --chat or --user')
+
+        chunks = transcript_chunks(transcript_messages(chat_ids), options['output'])
+        if options['gzip']:
+            chunks = gzip_chunks(chunks)
+
+        target = open(options['file'], 'wb') if options['file'] else sys.stdout.buffer
+        written = 0
+        try:
+            for chunk in chunks:
+                target.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['file']:
+                target.close()
+            else:
+                target.flush()
+        if options['file']:
+            self.stdout.write(self.style.SUCCESS('Wrote %s bytes to %s' % (written, options['file'])))
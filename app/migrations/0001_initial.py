@@ -1,11 +1,12 @@
 # Generated by Django 3.2.9 on 2021-11-14 13:38
 
 from django.db import migrations
-from django.contrib.auth.models import User
 from django.conf import settings
 
 
 def generate_superuser(apps, schema_editor):
+    # the historical model keeps signals of later models (AuthorStats) out of this migration
+    User = apps.get_model('auth', 'User')
     User.objects.create_superuser(
         username=settings.DJANGO_SUPERUSER_USERNAME,
         email=settings.DJANGO_SUPERUSER_EMAIL,
@@ -16,7 +17,9 @@ def generate_superuser(apps, schema_editor):
 
 
 class Migration(migrations.Migration):
-    dependencies = []
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
 
     operations = [
         migrations.RunPython(generate_superuser),
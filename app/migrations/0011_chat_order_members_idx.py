@@ -0,0 +1,17 @@
+# Generated by Django 3.2.9 on 2026-10-17 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['order', 'producer', 'consumer'], name='chat_order_members_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.9 on 2026-10-17 10:00
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX order_search_vector_idx ON app_order USING gin (search_vector)'
+        )
+        schema_editor.execute(
+            "UPDATE app_order o SET search_vector = "
+            "setweight(to_tsvector(%(config)s, coalesce(o.title, '')), 'A') || "
+            "setweight(to_tsvector(%(config)s, coalesce(o.description, '')), 'B') || "
+            "setweight(to_tsvector(%(config)s, coalesce(c.name, '')), 'C') "
+            "FROM app_category c WHERE c.id = o.category_id",
+            params={'config': settings.ORDER_SEARCH_CONFIG},
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE app_order_fts USING fts5("
+            "title, description, category, tokenize='unicode61', prefix='2 3')"
+        )
+        schema_editor.execute(
+            'INSERT INTO app_order_fts (rowid, title, description, category) '
+            'SELECT o.id, o.title, o.description, c.name FROM app_order o '
+            'JOIN app_category c ON c.id = o.category_id'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS order_search_vector_idx')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS app_order_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_chat_order_members_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
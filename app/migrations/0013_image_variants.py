@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-17 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_order_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.9 on 2026-10-17 11:00
+
+from collections import Counter
+
+import core.storage
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    Image = apps.get_model('app', 'Image')
+    Blob = apps.get_model('app', 'Blob')
+    counts = Counter()
+    for name, variants in Image.objects.values_list('file', 'variants').iterator():
+        counts.update([name, *variants.values()])
+    Blob.objects.bulk_create(
+        [Blob(name=name, references=count) for name, count in counts.items() if name],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('references', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='file',
+            field=models.FileField(storage=core.storage.ContentAddressedStorage(), upload_to=''),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.9 on 2026-10-17 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_blob_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='image',
+            options={'ordering': ('position', 'id')},
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['order', 'position'], name='image_order_position_idx'),
+        ),
+    ]
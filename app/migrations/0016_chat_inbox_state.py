@@ -0,0 +1,68 @@
+# Generated by Django 3.2.9 on 2026-10-17 12:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_inbox_state(apps, schema_editor):
+    # existing conversations start out read up to their last message
+    Chat = apps.get_model('app', 'Chat')
+    Message = apps.get_model('app', 'Message')
+    latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-created_at', '-id')
+    Chat.objects.update(
+        last_message=Subquery(latest.values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+    )
+    Chat.objects.update(producer_last_read=F('last_message'), consumer_last_read=F('last_message'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_image_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='producer_last_read',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='consumer_last_read',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='producer_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='consumer_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_inbox_state, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['producer', '-last_activity_at'], name='chat_producer_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['consumer', '-last_activity_at'], name='chat_consumer_activity_idx'),
+        ),
+    ]
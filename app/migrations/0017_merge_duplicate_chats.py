@@ -0,0 +1,61 @@
+# Generated by Django 3.2.9 on 2026-10-17 12:30
+
+from django.db import migrations, transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+
+
+def merge_duplicate_chats(apps, schema_editor):
+    """
+    Fold every chat into the oldest one with the same order and members
+    Messages are moved in batches, each in its own transaction, so the
+    table is never locked for the whole backfill
+    """
+
+    Chat = apps.get_model('app', 'Chat')
+    Message = apps.get_model('app', 'Message')
+    groups = (
+        Chat.objects.values('order', 'producer', 'consumer')
+        .annotate(chats=Count('id'), keeper=Min('id'))
+        .filter(chats__gt=1)
+        .order_by()
+    )
+    for group in list(groups):
+        members = Chat.objects.filter(order=group['order'], producer=group['producer'], consumer=group['consumer'])
+        duplicates = list(members.exclude(pk=group['keeper']).values_list('id', flat=True))
+
+        while True:
+            with transaction.atomic():
+                batch = list(Message.objects.filter(chat_id__in=duplicates).values_list('id', flat=True)[:BATCH_SIZE])
+                if not batch:
+                    break
+                Message.objects.filter(pk__in=batch).update(chat_id=group['keeper'])
+
+        with transaction.atomic():
+            state = members.aggregate(
+                producer_last_read=Max('producer_last_read'),
+                consumer_last_read=Max('consumer_last_read'),
+                producer_unread=Sum('producer_unread'),
+                consumer_unread=Sum('consumer_unread'),
+            )
+            latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-created_at', '-id')
+            Chat.objects.filter(pk=group['keeper']).update(
+                last_message=Subquery(latest.values('id')[:1]),
+                last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+                **state,
+            )
+            Chat.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app', '0016_chat_inbox_state'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_chats, migrations.RunPython.noop),
+    ]
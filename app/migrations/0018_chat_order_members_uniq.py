@@ -0,0 +1,21 @@
+# Generated by Django 3.2.9 on 2026-10-17 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_merge_duplicate_chats'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(fields=('order', 'producer', 'consumer'), name='chat_order_members_uniq'),
+        ),
+        migrations.RemoveIndex(
+            model_name='chat',
+            name='chat_order_members_idx',
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.2.9 on 2026-10-17 13:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+BATCH_SIZE = 1000
+
+
+def fill_author_stats(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Order = apps.get_model('app', 'Order')
+    Comment = apps.get_model('app', 'Comment')
+    AuthorStats = apps.get_model('app', 'AuthorStats')
+
+    comments = dict(Comment.objects.values('user').annotate(count=Count('pk')).values_list('user', 'count'))
+    written = dict(Comment.objects.values('author').annotate(last=Max('created_at')).values_list('author', 'last'))
+    orders = {
+        author: (count, active, last)
+        for author, count, active, last in Order.objects.values('author').annotate(
+            count=Count('pk'), active=Count('pk', filter=Q(is_active=True)), last=Max('updated_at'),
+        ).values_list('author', 'count', 'active', 'last')
+    }
+
+    rows = []
+    for user_id, date_joined in User.objects.values_list('pk', 'date_joined').iterator():
+        order_count, active_count, ordered = orders.get(user_id, (0, 0, None))
+        rows.append(AuthorStats(
+            user_id=user_id,
+            comment_count=comments.get(user_id, 0),
+            order_count=order_count,
+            active_order_count=active_count,
+            last_activity_at=max(filter(None, (date_joined, ordered, written.get(user_id)))),
+        ))
+        if len(rows) >= BATCH_SIZE:
+            AuthorStats.objects.bulk_create(rows)
+            rows = []
+    AuthorStats.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0019_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthorStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('comment_count', models.IntegerField(default=0)),
+                ('order_count', models.IntegerField(default=0)),
+                ('active_order_count', models.IntegerField(default=0)),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(fill_author_stats, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='authorstats',
+            index=models.Index(fields=['comment_count', 'user'], name='author_stats_comments_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='authorstats',
+            index=models.Index(fields=['order_count', 'user'], name='author_stats_orders_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='authorstats',
+            index=models.Index(fields=['active_order_count', 'user'], name='author_stats_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='authorstats',
+            index=models.Index(fields=['last_activity_at', 'user'], name='author_stats_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.9 on 2026-10-17 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_authorstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='comment_user_created_idx'),
+        ),
+    ]
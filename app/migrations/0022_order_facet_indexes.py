@@ -0,0 +1,21 @@
+# Generated by Django 3.2.9 on 2026-10-17 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_comment_user_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['is_active', 'category', 'price'], name='order_active_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['is_active', 'price'], name='order_active_price_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.9 on 2026-10-17 15:00
+
+from django.db import migrations, models
+
+import core.operations
+
+
+class Migration(migrations.Migration):
+    # indexes are built concurrently on PostgreSQL, which cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('app', '0022_order_facet_indexes'),
+    ]
+
+    operations = [
+        core.operations.AddIndexConcurrentlyIfSupported(
+            model_name='order',
+            index=models.Index(
+                condition=models.Q(('is_active', True)), fields=['-created_at', '-id'], name='order_active_feed_idx'),
+        ),
+        core.operations.AddIndexConcurrentlyIfSupported(
+            model_name='order',
+            index=models.Index(
+                condition=models.Q(('is_active', True)), fields=['category', '-created_at', '-id'],
+                name='order_active_category_feed_idx'),
+        ),
+        core.operations.AddIndexConcurrentlyIfSupported(
+            model_name='order',
+            index=models.Index(
+                fields=['author', '-created_at', '-id'], include=('is_active', 'updated_at'),
+                name='order_author_feed_idx'),
+        ),
+        core.operations.RemoveIndexConcurrentlyIfSupported(
+            model_name='order',
+            name='order_active_created_idx',
+        ),
+    ]
@@ -1,7 +1,15 @@
+from collections import Counter, defaultdict
+
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 from core.base_enum import BaseEnum
+from core.storage import ContentAddressedStorage
 
 
 class DateMixin(models.Model):
@@ -22,6 +30,17 @@ class Category(models.Model):
         return self.name
 
 
+class OrderQuerySet(models.QuerySet):
+
+    def with_viewer_chat(self, user):
+        """
+        Annotate viewer_chat_id, the first chat of each order the user takes part in
+        """
+
+        chats = Chat.objects.filter(order=OuterRef('pk')).filter(Q(producer=user) | Q(consumer=user))
+        return self.annotate(viewer_chat_id=Subquery(chats.order_by('id').values('id')[:1]))
+
+
 class Order(DateMixin):
     is_active = models.BooleanField(default=True)
     title = models.CharField(max_length=128, blank=False, null=False)
@@ -29,6 +48,25 @@ class Order(DateMixin):
     author = models.ForeignKey(User, on_delete=models.CASCADE, null=False)
     price = models.BigIntegerField(null=False)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_active', 'category', 'price'], name='order_active_category_idx'),
+            models.Index(fields=['is_active', 'price'], name='order_active_price_idx'),
+            # the public feeds only ever read active orders, partial indexes leave the inactive ones out
+            models.Index(
+                fields=['-created_at', '-id'], condition=Q(is_active=True), name='order_active_feed_idx'),
+            models.Index(
+                fields=['category', '-created_at', '-id'], condition=Q(is_active=True),
+                name='order_active_category_feed_idx'),
+            # an author's own feed shows both states, the included columns answer its freshness stamp
+            models.Index(
+                fields=['author', '-created_at', '-id'], include=['is_active', 'updated_at'],
+                name='order_author_feed_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -36,7 +74,71 @@ class Order(DateMixin):
 
 class Image(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
-    file = models.FileField()
+    file = models.FileField(storage=ContentAddressedStorage())
+    variants = models.JSONField(default=dict, blank=True)
+    position = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('position', 'id')
+        indexes = [
+            models.Index(fields=['order', 'position'], name='image_order_position_idx'),
+        ]
+
+    def stored_names(self):
+        return [self.file.name, *self.variants.values()]
+
+
+class BlobQuerySet(models.QuerySet):
+
+    def acquire(self, names):
+        counts = Counter(name for name in names if name)
+        self.bulk_create([Blob(name=name) for name in counts], ignore_conflicts=True)
+        self._add_references(counts)
+
+    def release(self, names):
+        counts = Counter(name for name in names if name)
+        self._add_references({name: -count for name, count in counts.items()})
+
+    def _add_references(self, counts):
+        names_by_count = defaultdict(list)
+        for name, count in counts.items():
+            names_by_count[count].append(name)
+        for count, names in names_by_count.items():
+            self.filter(name__in=names).update(references=F('references') + count, updated_at=timezone.now())
+
+
+class Blob(models.Model):
+    """
+    Reference count of a stored file across Image rows (originals and variants)
+    Blobs nobody references are removed after the commit releasing them,
+    or by the collect_media_garbage command when their files were touched recently
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    references = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = BlobQuerySet.as_manager()
+
+
+class IdempotencyKey(models.Model):
+    """
+    Outcome of a request retried under the same client key, replayed until expires_at
+    A row without a status_code belongs to a request that is still running
+    Expired rows are removed by the purge_idempotency_keys command
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=64)
+    fingerprint = models.CharField(max_length=64, blank=True)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_user_key_uniq'),
+        ]
 
 
 class Comment(DateMixin):
@@ -44,11 +146,166 @@ class Comment(DateMixin):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user_comments')
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='author_comments')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='comment_user_created_idx'),
+        ]
+
+
+class AuthorStatsQuerySet(models.QuerySet):
+
+    def add(self, user_id, touch=False, **deltas):
+        """
+        Apply counter deltas to a user's row in one UPDATE, touch moves last_activity_at to now
+        Rows are created with the user, a missing one is filled in by recount
+        """
+
+        updates = {counter: F(counter) + delta for counter, delta in deltas.items() if delta}
+        if touch:
+            updates['last_activity_at'] = timezone.now()
+        if updates:
+            self.filter(user_id=user_id).update(**updates)
+
+    def recount(self, user_ids, touch=True):
+        """
+        Recompute the counters of some users from their own rows,
+        for writes that bypass the signals (update(), bulk_create)
+        """
+
+        user_ids = set(user_ids)
+        self.bulk_create([AuthorStats(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+
+        def count(queryset, field):
+            counted = queryset.filter(**{field: OuterRef('user')}).order_by().values(field).annotate(
+                count=Count('pk')).values('count')
+            return Coalesce(Subquery(counted), 0, output_field=models.IntegerField())
+
+        updates = {
+            'comment_count': count(Comment.objects.all(), 'user'),
+            'order_count': count(Order.objects.all(), 'author'),
+            'active_order_count': count(Order.objects.filter(is_active=True), 'author'),
+        }
+        if touch:
+            updates['last_activity_at'] = timezone.now()
+        self.filter(user_id__in=user_ids).update(**updates)
+
+
+class AuthorStats(models.Model):
+    """
+    Counters of a user kept up to date by the Comment and Order signals,
+    ranking authors never aggregates the comments or orders tables
+    comment_count counts the comments left about the user
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    comment_count = models.IntegerField(default=0)
+    order_count = models.IntegerField(default=0)
+    active_order_count = models.IntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    objects = AuthorStatsQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['comment_count', 'user'], name='author_stats_comments_idx'),
+            models.Index(fields=['order_count', 'user'], name='author_stats_orders_idx'),
+            models.Index(fields=['active_order_count', 'user'], name='author_stats_active_idx'),
+            models.Index(fields=['last_activity_at', 'user'], name='author_stats_activity_idx'),
+        ]
+
+
+class ChatQuerySet(models.QuerySet):
+
+    def for_member(self, user):
+        return self.filter(Q(producer=user) | Q(consumer=user))
+
+    def with_viewer_state(self, user):
+        """
+        Annotate unread and last_read_message_id from the side of the chat the user is on
+        """
+
+        is_producer = Q(producer=user)
+        return self.annotate(
+            unread=Case(When(is_producer, then=F('producer_unread')), default=F('consumer_unread')),
+            last_read_message_id=Case(
+                When(is_producer, then=F('producer_last_read')),
+                default=F('consumer_last_read'),
+                output_field=models.BigIntegerField(),
+            ),
+        )
+
+    def record_messages(self, messages):
+        """
+        Move the last message pointer and the unread counters of each chat
+        a batch of freshly inserted messages belongs to, one UPDATE per chat
+        A message is unread for every participant other than its sender
+        """
+
+        by_chat = defaultdict(list)
+        for message in messages:
+            by_chat[message.chat_id].append(message)
+
+        latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-created_at', '-id').values('id')[:1]
+        for chat_id, chat_messages in by_chat.items():
+            senders = Counter(message.sender_id for message in chat_messages)
+
+            def received(member):
+                sent = Case(
+                    *(When(**{'%s_id' % member: sender}, then=Value(count)) for sender, count in senders.items()),
+                    default=Value(0),
+                    output_field=models.PositiveIntegerField(),
+                )
+                return F('%s_unread' % member) + Value(len(chat_messages), models.PositiveIntegerField()) - sent
+
+            self.filter(pk=chat_id).update(
+                last_message=Subquery(latest),
+                last_activity_at=max(message.created_at for message in chat_messages),
+                producer_unread=received('producer'),
+                consumer_unread=received('consumer'),
+            )
+
+    def mark_read(self, chat_id, user_id) -> int:
+        """
+        Move the user's read pointer to the last message of the chat in one UPDATE
+        Returns 0 when the user is not a member of the chat
+        """
+
+        def side(member, field, value):
+            output_field = self.model._meta.get_field(field)
+            return Case(When(**{'%s_id' % member: user_id}, then=value), default=F(field), output_field=output_field)
+
+        return self.filter(Q(producer_id=user_id) | Q(consumer_id=user_id), pk=chat_id).update(
+            producer_last_read=side('producer', 'producer_last_read', F('last_message')),
+            consumer_last_read=side('consumer', 'consumer_last_read', F('last_message')),
+            producer_unread=side('producer', 'producer_unread', 0),
+            consumer_unread=side('consumer', 'consumer_unread', 0),
+        )
+
 
 class Chat(DateMixin):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='order_chats')
     producer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='producer_chats')
     consumer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='consumer_chats')
+    # inbox state kept next to the chat so listing it never touches the messages table
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    producer_last_read = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    consumer_last_read = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    producer_unread = models.PositiveIntegerField(default=0)
+    consumer_unread = models.PositiveIntegerField(default=0)
+
+    objects = ChatQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'producer', 'consumer'], name='chat_order_members_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['producer', '-last_activity_at'], name='chat_producer_activity_idx'),
+            models.Index(fields=['consumer', '-last_activity_at'], name='chat_consumer_activity_idx'),
+        ]
 
 
 class Message(DateMixin):
@@ -60,3 +317,8 @@ class Message(DateMixin):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     message_type = models.PositiveSmallIntegerField(choices=MessageTypes.items())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_created_idx'),
+        ]
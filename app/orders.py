@@ -0,0 +1,180 @@
+import codecs
+import csv
+import json
+from functools import partial
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+from typing import Iterable
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+
+from app.models import AuthorStats, Category, Order
+from app.search import refresh_order_search
+from app.serializers import ImportOrderSerializer
+from core.cache import invalidate
+
+
+def orders_changed(author_id, order_ids: Iterable[int] = (), touch=True, using='default', **deltas):
+    """
+    Side effects of writing orders of an author, run by the Order signals and by
+    the bulk writes that bypass them: the search documents of order_ids are rebuilt,
+    the author's counters move by deltas and the cached lists and author pages are invalidated
+    """
+
+    order_ids = list(order_ids)
+    if order_ids:
+        refresh_order_search(order_ids, using=using)
+    AuthorStats.objects.add(author_id, touch=touch, **deltas)
+    invalidate('user_orders', author_id)
+    invalidate('authors', author_id)
+    invalidate('authors', 'list')
+
+
+def set_orders_active(author: User, order_ids: Iterable[int], is_active: bool) -> int:
+    """
+    Move orders of an author to a state in one conditional UPDATE, the author check
+    is part of the WHERE clause and orders already in that state are left untouched
+    update() skips the Order signals, their side effects are applied by orders_changed
+    Returns the number of orders that changed
+    """
+
+    changed = (
+        Order.objects.filter(pk__in=list(order_ids), author=author)
+        .exclude(is_active=is_active)
+        .update(is_active=is_active, updated_at=timezone.now())
+    )
+    if changed:
+        orders_changed(author.pk, active_order_count=changed if is_active else -changed)
+    return changed
+
+
+def read_rows(stream, content_type: str):
+    """
+    Records of an NDJSON or CSV body, read line by line so the body is never held in memory
+    The body is spooled to a temporary file first, so one that is empty or not UTF-8
+    is rejected with a ParseError before any row is imported
+    Returns an iterator of (row number, record or None when the line is not valid JSON)
+    """
+
+    if stream is None:
+        raise ParseError('The body is empty.')
+    body = SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter(partial(stream.read, 64 * 1024), b''):
+            decoder.decode(chunk)
+            body.write(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        body.close()
+        raise ParseError('The body is not UTF-8 encoded.')
+    body.seek(0)
+    return _records(body, content_type)
+
+
+def _records(body, content_type):
+    with body:
+        lines = (line.decode('utf-8') for line in body)
+        if content_type == 'text/csv':
+            yield from enumerate(csv.DictReader(lines), start=1)
+            return
+        number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, record if isinstance(record, dict) else None
+
+
+def import_orders(author: User, rows) -> dict:
+    """
+    Validate rows with ImportOrderSerializer and insert the valid ones with bulk_create,
+    one transaction per chunk so a huge import never holds locks for long
+    bulk_create skips the Order signals, their side effects are applied per chunk by orders_changed
+    Returns the number of created orders and the errors of rejected rows
+    """
+
+    config = settings.ORDER_BULK
+    context = {'category_ids': set(Category.objects.values_list('id', flat=True))}
+    created, errors = 0, []
+    rows = iter(rows)
+    for chunk in _chunks(islice(rows, config['IMPORT_MAX_ROWS']), config['IMPORT_CHUNK_SIZE']):
+        orders = []
+        for number, record in chunk:
+            if record is None:
+                errors.append({'row': number, 'errors': {'detail': ['Invalid JSON object.']}})
+                continue
+            serializer = ImportOrderSerializer(data=record, context=context)
+            if not serializer.is_valid():
+                errors.append({'row': number, 'errors': serializer.errors})
+                continue
+            data = serializer.validated_data
+            orders.append(Order(author=author, category_id=data.pop('category'), **data))
+        if orders:
+            with transaction.atomic():
+                Order.objects.bulk_create(orders)
+                orders_changed(author.pk, _created_ids(author, orders), order_count=len(orders),
+                               active_order_count=sum(order.is_active for order in orders))
+            created += len(orders)
+    if next(rows, None) is not None:
+        errors.append({
+            'row': config['IMPORT_MAX_ROWS'] + 1,
+            'errors': {'detail': ['Imports are limited to %s rows.' % config['IMPORT_MAX_ROWS']]},
+        })
+    return {'created': created, 'errors': errors}
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _created_ids(author, orders):
+    if all(order.pk is not None for order in orders):
+        return [order.pk for order in orders]
+    # backends without INSERT ... RETURNING (SQLite) leave the pks unset, inside the
+    # transaction the newest rows of the author are the ones just inserted
+    return list(Order.objects.filter(author=author).order_by('-id').values_list('id', flat=True)[:len(orders)])
+
+
+EXPORT_FIELDS = ('id', 'title', 'description', 'price', 'category', 'is_active', 'created_at')
+
+
+def export_orders(queryset, output: str):
+    """
+    Lines of an NDJSON or CSV export, rows are fetched chunk by chunk through a server-side cursor
+    """
+
+    rows = (
+        row[:-1] + (row[-1].isoformat(),)
+        for row in queryset.values_list(*EXPORT_FIELDS).iterator(chunk_size=settings.ORDER_BULK['EXPORT_CHUNK_SIZE'])
+    )
+    if output == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+        return
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+
+class _Echo:
+    """
+    File-like target for csv.writer that hands each formatted row back instead of buffering it
+    """
+
+    def write(self, value):
+        return value
@@ -0,0 +1,93 @@
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.models import F, FloatField, TextField, Value
+from django.db.models.expressions import RawSQL
+
+from app.models import Order
+
+FTS_TABLE = 'app_order_fts'
+
+
+def parse_terms(text):
+    return re.findall(r'\w+', text or '')
+
+
+def refresh_order_search(order_ids=None, category=None, using='default'):
+    """
+    Rebuild the search document of the given orders or of every order of a category
+    Postgres keeps a weighted tsvector in Order.search_vector, SQLite an FTS5 row
+    """
+
+    if connections[using].vendor == 'postgresql':
+        orders = Order.objects.using(using)
+        if category is not None:
+            orders.filter(category=category).update(search_vector=order_search_vector(category.name))
+            return
+        # joined references are not allowed in UPDATE, so orders are refreshed per category
+        orders = orders.filter(pk__in=order_ids)
+        for category_id, name in orders.values_list('category_id', 'category__name').distinct():
+            orders.filter(category_id=category_id).update(search_vector=order_search_vector(name))
+    elif connections[using].vendor == 'sqlite':
+        if category is not None:
+            where, params = 'o.category_id = %s', [category.pk]
+        else:
+            order_ids = list(order_ids)
+            where, params = 'o.id IN (%s)' % ', '.join(['%s'] * len(order_ids)), order_ids
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {fts} WHERE rowid IN (SELECT o.id FROM app_order o WHERE {where})'.format(
+                    fts=FTS_TABLE, where=where),
+                params,
+            )
+            cursor.execute(
+                'INSERT INTO {fts} (rowid, title, description, category) '
+                'SELECT o.id, o.title, o.description, c.name FROM app_order o '
+                'JOIN app_category c ON c.id = o.category_id WHERE {where}'.format(fts=FTS_TABLE, where=where),
+                params,
+            )
+
+
+def remove_order_search(order_id, using='default'):
+    if connections[using].vendor == 'sqlite':
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM {fts} WHERE rowid = %s'.format(fts=FTS_TABLE), [order_id])
+
+
+def order_search_vector(category_name):
+    config = settings.ORDER_SEARCH_CONFIG
+    return (
+        SearchVector('title', weight='A', config=config)
+        + SearchVector('description', weight='B', config=config)
+        + SearchVector(Value(category_name, output_field=TextField()), weight='C', config=config)
+    )
+
+
+def search_orders(queryset, terms):
+    """
+    Filter orders matching every term as a prefix and annotate search_rank, higher is better
+    """
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        query = SearchQuery(
+            ' & '.join('%s:*' % term for term in terms),
+            search_type='raw',
+            config=settings.ORDER_SEARCH_CONFIG,
+        )
+        return queryset.filter(search_vector=query).annotate(search_rank=SearchRank(F('search_vector'), query))
+    if vendor == 'sqlite':
+        match = ' '.join('"%s"*' % term for term in terms)
+        return queryset.filter(
+            id__in=RawSQL('SELECT rowid FROM {fts} WHERE {fts} MATCH %s'.format(fts=FTS_TABLE), [match])
+        ).annotate(search_rank=RawSQL(
+            'SELECT -bm25({fts}, 10.0, 5.0, 1.0) FROM {fts} WHERE {fts} MATCH %s AND rowid = app_order.id'.format(
+                fts=FTS_TABLE),
+            [match],
+            output_field=FloatField(),
+        ))
+    for term in terms:
+        queryset = queryset.filter(title__icontains=term)
+    return queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
@@ -1,9 +1,11 @@
 from django.contrib.auth.models import User
 from django.db.models import Q
 from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
 from rest_framework import serializers
 from django.core.files.uploadedfile import TemporaryUploadedFile, InMemoryUploadedFile
 
+from app.images import store_images, update_images
 from app.models import Order, Category, Comment, Chat, Message, Image
 
 
@@ -90,6 +92,18 @@ class UserListSerializer(serializers.ModelSerializer):
         fields = ('id', 'first_name', 'last_name')
 
 
+class AuthorSerializer(UserListSerializer):
+    comment_count = serializers.IntegerField(read_only=True)
+    order_count = serializers.IntegerField(read_only=True)
+    active_order_count = serializers.IntegerField(read_only=True)
+    last_activity_at = serializers.DateTimeField(read_only=True)
+
+    class Meta(UserListSerializer.Meta):
+        fields = UserListSerializer.Meta.fields + (
+            'comment_count', 'order_count', 'active_order_count', 'last_activity_at',
+        )
+
+
 class OrderListSerializer(serializers.ModelSerializer):
     author = UserListSerializer()
     category = CategorySerializer()
@@ -99,10 +113,34 @@ class OrderListSerializer(serializers.ModelSerializer):
         fields = ('id', 'title', 'description', 'author', 'is_active', 'price', 'category', 'created_at')
 
 
+class OrderChatListSerializer(OrderListSerializer):
+    chat = serializers.IntegerField(source='viewer_chat_id', read_only=True)
+
+    class Meta(OrderListSerializer.Meta):
+        fields = OrderListSerializer.Meta.fields + ('chat',)
+
+
+class ImageVariantsField(serializers.Field):
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, variants):
+        storage = Image._meta.get_field('file').storage
+        request = self.context.get('request')
+        urls = {}
+        for variant, name in variants.items():
+            url = storage.url(name)
+            urls[variant] = request.build_absolute_uri(url) if request is not None else url
+        return urls
+
+
 class ImageListSerializer(serializers.ModelSerializer):
+    variants = ImageVariantsField()
+
     class Meta:
         model = Image
-        fields = ('id', 'file')
+        fields = ('id', 'file', 'variants', 'position')
 
 
 class OrderRetrieveSerializer(serializers.ModelSerializer):
@@ -127,14 +165,23 @@ class OrderRetrieveSerializer(serializers.ModelSerializer):
         )
 
     def get_chat(self, order: Order):
+        if hasattr(order, 'viewer_chat_id'):
+            return order.viewer_chat_id
         chat = order.order_chats.filter(
             Q(producer=self.context['request'].user) | Q(consumer=self.context['request'].user)).first()
         return chat.id if chat else None
 
 
 class UpdateOrderSerializer(serializers.ModelSerializer):
-    images = serializers.CharField(required=False, allow_blank=True)
+    images = serializers.CharField(required=False, allow_blank=True, write_only=True)
+
+    def validate_images(self, value):
+        try:
+            return [int(str_id) for str_id in value.split(',') if str_id]
+        except ValueError:
+            raise serializers.ValidationError('Expected a comma-separated list of image ids.')
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         validated_data_copy = validated_data.copy()
         validated_files = []
@@ -142,11 +189,9 @@ class UpdateOrderSerializer(serializers.ModelSerializer):
             if isinstance(value, TemporaryUploadedFile) or isinstance(value, InMemoryUploadedFile):
                 validated_files.append(value)
                 validated_data.pop(key)
+        image_ids = validated_data.pop('images', None)
         order_instance = super(UpdateOrderSerializer, self).update(instance, validated_data)
-        image_ids = [int(str_id) for str_id in validated_data['images'].split(',') if str_id]
-        Image.objects.filter(order=instance).exclude(id__in=image_ids).delete()
-        for file in validated_files:
-            Image.objects.create(order=order_instance, file=file)
+        update_images(order_instance, image_ids, validated_files)
         return order_instance
 
     def __init__(self, *args, **kwargs):
@@ -172,8 +217,7 @@ class CreateOrderSerializer(serializers.ModelSerializer):
                 validated_files.append(value)
                 validated_data.pop(key)
         order_instance = super(CreateOrderSerializer, self).create(validated_data)
-        for file in validated_files:
-            Image.objects.create(order=order_instance, file=file)
+        store_images(order_instance, validated_files)
         return order_instance
 
     def __init__(self, *args, **kwargs):
@@ -189,6 +233,27 @@ class CreateOrderSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'author', 'is_active', 'created_at')
 
 
+class ImportOrderSerializer(CreateOrderSerializer):
+    """
+    One row of a bulk import, categories are checked against the ids loaded once per import
+    """
+
+    category = serializers.IntegerField()
+
+    def validate_category(self, value):
+        if value not in self.context['category_ids']:
+            raise serializers.ValidationError('Invalid pk "%s" - object does not exist.' % value)
+        return value
+
+
+class OrderStatusSerializer(serializers.Serializer):
+    is_active = serializers.BooleanField()
+
+
+class BulkOrderStatusSerializer(OrderStatusSerializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=1000)
+
+
 class CommentListSerializer(serializers.ModelSerializer):
     author = UserListSerializer()
     user = UserListSerializer()
@@ -221,20 +286,36 @@ class CommentSerializer(serializers.ModelSerializer):
         return super(CommentSerializer, self).create(validated_data)
 
 
-class ChatListSerializer(serializers.ModelSerializer):
-    order = ShortOrderSerializer()
-    producer = UserListSerializer()
-    consumer = UserListSerializer()
+class MessageListSerializer(serializers.ModelSerializer):
+    sender = ShortUserSerializer()
 
     class Meta:
-        model = Chat
-        fields = ('id', 'order', 'producer', 'consumer', 'created_at')
-        read_only_fields = ('id', 'created_at')
+        model = Message
+        fields = ('id', 'text', 'sender', 'message_type', 'created_at')
 
 
-class MessageListSerializer(serializers.ModelSerializer):
-    sender = ShortUserSerializer()
+class MessageCreateSerializer(serializers.ModelSerializer):
+    """
+    Fields of a chat message frame sent over a websocket
+    """
 
     class Meta:
         model = Message
-        fields = ('id', 'text', 'sender', 'message_type', 'created_at')
+        fields = ('text', 'message_type')
+
+
+class ChatListSerializer(serializers.ModelSerializer):
+    order = ShortOrderSerializer()
+    producer = UserListSerializer()
+    consumer = UserListSerializer()
+    last_message = MessageListSerializer(read_only=True)
+    unread = serializers.IntegerField(read_only=True)
+    last_read_message = serializers.IntegerField(source='last_read_message_id', read_only=True)
+
+    class Meta:
+        model = Chat
+        fields = (
+            'id', 'order', 'producer', 'consumer', 'created_at',
+            'last_message', 'last_activity_at', 'unread', 'last_read_message',
+        )
+        read_only_fields = ('id', 'created_at', 'last_activity_at')
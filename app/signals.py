@@ -0,0 +1,107 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from app.images import release_blobs
+from app.models import AuthorStats, Category, Comment, Image, Order
+from app.orders import orders_changed
+from app.search import refresh_order_search, remove_order_search
+from core.cache import invalidate
+
+
+@receiver(post_delete, sender=Order)
+def delete_order_search(sender, instance, using, **kwargs):
+    remove_order_search(instance.pk, using=using)
+
+
+@receiver(post_save, sender=Category)
+def update_category_search(sender, instance, created, using, **kwargs):
+    if not created:
+        refresh_order_search(category=instance, using=using)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_cache(sender, **kwargs):
+    invalidate('categories')
+    invalidate('user_orders')
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_cache(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    invalidate('authors', instance.pk)
+    invalidate('authors', 'list')
+    invalidate('user_orders', instance.pk)
+    # user names are rendered inside orders and messages, their ETags are stamped with it
+    invalidate('users')
+
+
+@receiver(post_delete, sender=Image)
+def release_image_blobs(sender, instance, using, **kwargs):
+    release_blobs(instance.stored_names(), using=using)
+
+
+@receiver(post_save, sender=User)
+def create_author_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        AuthorStats.objects.bulk_create([AuthorStats(user=instance)], ignore_conflicts=True)
+
+
+@receiver(pre_save, sender=Order)
+@receiver(pre_save, sender=Comment)
+def remember_counted_state(sender, instance, **kwargs):
+    """
+    Keep the counted fields as stored before an update, post_save turns them into deltas
+    """
+
+    if not instance._state.adding:
+        fields = ('author_id', 'is_active') if sender is Order else ('user_id',)
+        instance._counted = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+@receiver(post_save, sender=Order)
+def count_saved_order(sender, instance, created, using, **kwargs):
+    previous = getattr(instance, '_counted', None)
+    active = int(instance.is_active)
+    if created:
+        orders_changed(instance.author_id, [instance.pk], using=using, order_count=1, active_order_count=active)
+    elif previous is None:
+        AuthorStats.objects.recount([instance.author_id])
+        orders_changed(instance.author_id, [instance.pk], using=using)
+    elif previous[0] != instance.author_id:
+        orders_changed(previous[0], touch=False, order_count=-1, active_order_count=-int(previous[1]))
+        orders_changed(instance.author_id, [instance.pk], using=using, order_count=1, active_order_count=active)
+    else:
+        orders_changed(instance.author_id, [instance.pk], using=using, active_order_count=active - int(previous[1]))
+
+
+@receiver(post_delete, sender=Order)
+def count_deleted_order(sender, instance, **kwargs):
+    orders_changed(instance.author_id, touch=False, order_count=-1, active_order_count=-int(instance.is_active))
+
+
+@receiver(post_save, sender=Comment)
+def count_saved_comment(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_counted', None)
+    if created:
+        AuthorStats.objects.add(instance.user_id, comment_count=1)
+    elif previous is not None and previous[0] != instance.user_id:
+        AuthorStats.objects.add(previous[0], comment_count=-1)
+        AuthorStats.objects.add(instance.user_id, comment_count=1)
+    AuthorStats.objects.add(instance.author_id, touch=True)
+    invalidate_author_stats({instance.user_id, instance.author_id, *(previous or ())})
+
+
+@receiver(post_delete, sender=Comment)
+def count_deleted_comment(sender, instance, **kwargs):
+    AuthorStats.objects.add(instance.user_id, comment_count=-1)
+    invalidate_author_stats([instance.user_id])
+
+
+def invalidate_author_stats(user_ids):
+    for user_id in set(user_ids):
+        invalidate('authors', user_id)
+    invalidate('authors', 'list')
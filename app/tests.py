@@ -1,3 +1,916 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image as Picture, features
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from app.benchmarks import PAGE_SIZE, seed_page, serializer_querysets
+from app.idempotency import claim, idempotent, key_digest
+from app.images import render_variants, store_images, update_images
+from app.models import AuthorStats, Blob, Category, Chat, ChatQuerySet, Comment, IdempotencyKey, Image, Message, Order
+from app.orders import set_orders_active
+from app.serializers import MessageListSerializer, OrderChatListSerializer, OrderRetrieveSerializer
+from app.views import OrderViewSet
+from chat_consumer.membership import is_chat_member
+from core.cache import get_cache, get_or_compute
+from core.compiled import compiled_for
+from core.pagination import KeysetPagination
+from core.renderers import FastJSONRenderer
+
+# the tests run in one process, they do not need the shared redis cache
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class APITestCase(TestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        # responses cached by an earlier test would be served without a query
+        get_cache().clear()
+
+    def get(self, url, queries=None):
+        if queries is None:
+            response = self.client.get(url)
+        else:
+            with self.assertNumQueries(queries):
+                response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+
+class QueryBudgetTests(APITestCase):
+    """
+    Queries of the list endpoints with a full page of rows, a higher count than
+    budgeted usually means something is loaded per row again
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.ids = seed_page()
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def assertPage(self, url, queries):
+        response = self.get(url.format(**self.ids), queries)
+        if 'results' in response.data:
+            self.assertEqual(len(response.data['results']), PAGE_SIZE)
+        return response
+
+    def test_order_feed(self):
+        # freshness stamps of the orders and of the viewer's chats, then the page (and its count)
+        self.assertPage('/api/orders/', 4)
+        self.assertPage('/api/orders/?before=', 3)
+
+    def test_order_feed_facets(self):
+        self.assertPage('/api/orders/?facets=1&ordering=price', 5)
+
+    def test_order_detail(self):
+        self.assertPage('/api/orders/{order}/', 4)
+
+    def test_user_orders(self):
+        self.assertPage('/api/user/orders/', 2)
+        get_cache().clear()
+        self.assertPage('/api/user/orders/?before=', 1)
+
+    def test_user_orders_cached(self):
+        self.assertPage('/api/user/orders/', 2)
+        self.assertPage('/api/user/orders/', 0)
+
+    def test_chats(self):
+        self.assertPage('/api/chats/', 2)
+
+    def test_chat_messages(self):
+        self.assertPage('/api/chats/{chat}/messages/', 3)
+        self.assertPage('/api/chats/{chat}/messages/?before=', 2)
+
+    def test_comments(self):
+        self.assertPage('/api/comments/', 2)
+
+    def test_comments_about_user(self):
+        self.assertPage('/api/comments/{commented}/user/', 2)
+        self.assertPage('/api/comments/{commented}/user/?before=', 1)
+
+    def test_categories(self):
+        self.assertPage('/api/categories/', 1)
+
+    def test_authors(self):
+        self.assertPage('/api/authors/', 1)
+
+
+class CompiledSerializerTests(APITestCase):
+    """
+    Compiled values() serializers have to render the bytes of their DRF serializers
+    """
+
+    # values that trip encoders: non-ASCII text, JavaScript line separators, quotes and escapes
+    text = 'Привет, мир 😀 \u2028\u2029 "quoted" \\ \t\n</script>'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.ids = seed_page()
+        Order.objects.create(title=cls.text, description=cls.text, author=cls.user, price=2 ** 40,
+                             category=Category.objects.first())
+        messages = list(Message.objects.filter(chat_id=cls.ids['chat']))
+        messages.append(Message.objects.create(
+            chat_id=cls.ids['chat'], sender=cls.user, text=cls.text, message_type=Message.MessageTypes.TEXT.value))
+        Chat.objects.record_messages(messages)
+        # a chat without messages renders last_message as null
+        Chat.objects.create(order=Order.objects.get(pk=cls.ids['order']), producer=cls.user, consumer=cls.user)
+
+    def test_same_bytes(self):
+        for serializer_class, queryset in serializer_querysets(self.user, self.ids['chat']):
+            with self.subTest(serializer_class.__name__):
+                compiled = compiled_for(serializer_class)
+                self.assertIsNotNone(compiled)
+                self.assertTrue(compiled.supports(queryset))
+                expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+                data = compiled.serialize(compiled.project(queryset))
+                self.assertEqual(JSONRenderer().render(data), expected)
+                self.assertEqual(FastJSONRenderer().render(data), expected)
+
+    def test_endpoints_render_same_bytes(self):
+        self.client.force_authenticate(self.user)
+        for url in (
+            '/api/orders/',
+            '/api/orders/?before=',
+            '/api/orders/?ordering=price&page=2',
+            '/api/user/orders/',
+            '/api/chats/',
+            '/api/chats/{chat}/messages/?before=',
+        ):
+            with self.subTest(url):
+                url = url.format(**self.ids)
+                compiled = self.get(url).content
+                get_cache().clear()
+                with mock.patch('core.compiled.compiled_for', return_value=None):
+                    self.assertEqual(compiled, self.get(url).content)
+
+    def test_missing_annotation_is_not_supported(self):
+        compiled = compiled_for(OrderChatListSerializer)
+        self.assertEqual(compiled.annotations, {'viewer_chat_id'})
+        self.assertFalse(compiled.supports(Order.objects.all()))
+
+    def test_serializers_needing_drf_are_not_compiled(self):
+        # method fields and nested many relations are rendered by DRF
+        self.assertIsNone(compiled_for(OrderRetrieveSerializer))
+
+    def test_renderer_matches_json_renderer(self):
+        data = {
+            'text': self.text,
+            'when': timezone.now(),
+            'price': Decimal('10.50'),
+            'nested': [{'id': 2 ** 70, 'none': None, 'flag': True}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONRenderer().render(data, 'application/json; indent=4'),
+            JSONRenderer().render(data, 'application/json; indent=4'),
+        )
+
+
+class CommentsAboutUserTests(APITestCase):
+    """
+    Keyset pages of the comments about a user, walked through their next links
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='commented')
+        authors = [User.objects.create(username='commenter_%s' % index) for index in range(3)]
+        for index in range(PAGE_SIZE * 2 + 5):
+            Comment.objects.create(user=cls.user, author=authors[index % 3], message='Comment %s' % index)
+        Comment.objects.create(user=authors[0], author=cls.user, message='About someone else')
+        # rows sharing a timestamp are told apart by their id
+        Comment.objects.filter(user=cls.user, pk__in=Comment.objects.filter(user=cls.user).values('pk')[:PAGE_SIZE])\
+            .update(created_at=timezone.now())
+
+    def test_walk(self):
+        expected = list(Comment.objects.filter(user=self.user).order_by('-created_at', '-id').values_list(
+            'pk', flat=True))
+        seen = []
+        url = '/api/comments/%s/user/?before=' % self.user.pk
+        while url:
+            data = self.get(url, 1).data
+            seen += [comment['id'] for comment in data['results']]
+            url = data['next']
+        self.assertEqual(seen, expected)
+
+    def test_catch_up(self):
+        expected = list(Comment.objects.filter(user=self.user).order_by('created_at', 'id'))
+        seen = []
+        url = '/api/comments/%s/user/?after=%s' % (self.user.pk, KeysetPagination.encode_cursor(expected[0]))
+        while url:
+            data = self.get(url, 1).data
+            seen += [comment['id'] for comment in data['results']]
+            previous, url = data['previous'], data['next']
+        self.assertEqual(seen, [comment.pk for comment in expected[1:]])
+        # the previous link of a catch-up page walks back from its first row
+        self.assertIn('before=', previous)
+        self.assertEqual([comment['id'] for comment in self.get(previous, 1).data['results']],
+                         [comment.pk for comment in expected[2 * PAGE_SIZE:PAGE_SIZE:-1]])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/comments/%s/user/?after=invalid' % self.user.pk).status_code, 404)
+
+    def test_page_numbers_stay_the_default(self):
+        data = self.get('/api/comments/%s/user/?page=2' % self.user.pk, 2).data
+        self.assertEqual(data['count'], PAGE_SIZE * 2 + 5)
+        self.assertEqual(len(data['results']), PAGE_SIZE)
+
+
+class MediaTestCase(APITestCase):
+    """
+    An order of the authenticated user, files are stored in a temporary MEDIA_ROOT
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.storage = Image._meta.get_field('file').storage
+        self.user = User.objects.create(username='author')
+        self.order = Order.objects.create(title='Order', description='Description', author=self.user, price=1,
+                                          category=Category.objects.create(name='Category'))
+        self.client.force_authenticate(self.user)
+
+    def age(self, name):
+        old = timezone.now().timestamp() - (settings.MEDIA_GARBAGE_GRACE_MINUTES + 1) * 60
+        os.utime(self.storage.path(name), (old, old))
+
+    @staticmethod
+    def picture(size=(64, 48)):
+        picture = BytesIO()
+        Picture.new('RGB', size).save(picture, 'PNG')
+        return SimpleUploadedFile('picture.png', picture.getvalue(), content_type='image/png')
+
+
+@skipUnless(features.check('webp'), 'Pillow is built without WebP')
+class ImageVariantTests(MediaTestCase):
+    """
+    Variants rendered after an order was fetched must reach clients holding its ETag
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.image = Image.objects.create(order=self.order, file=self.storage.save('picture.png', self.picture()))
+
+    def test_etag_changes_with_variants(self):
+        url = '/api/orders/%s/' % self.order.pk
+        etag = self.get(url)['ETag']
+
+        variants = render_variants(self.image.file.name)
+        self.assertEqual(set(variants), {'thumbnail', 'preview'})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(set(response.data['image_set'][0]['variants']), set(variants))
+
+
+class StoreImagesTests(MediaTestCase):
+    """
+    Uploads are stored once per content and inserted in bulk, their blobs acquired together
+    PNG and JPEG uploads, so the bookkeeping is covered where Pillow is built without WebP
+    """
+
+    @staticmethod
+    def photo(size=(64, 48)):
+        photo = BytesIO()
+        Picture.new('RGB', size).save(photo, 'JPEG')
+        return SimpleUploadedFile('photo.jpg', photo.getvalue(), content_type='image/jpeg')
+
+    def test_query_count_does_not_grow_with_uploads(self):
+        for count in (1, 4):
+            uploads = [self.picture((count, size)) for size in range(1, count + 1)] + [self.photo((count, 1))]
+            # rendered variants, images, blobs, references
+            with self.assertNumQueries(4), mock.patch('app.images.schedule_variants') as schedule_variants, \
+                    self.captureOnCommitCallbacks(execute=True):
+                images = store_images(self.order, uploads, position=10 * count)
+            names = [image.file.name for image in images]
+            self.assertEqual([posixpath.splitext(name)[1] for name in names], ['.png'] * count + ['.jpg'])
+            self.assertEqual(
+                list(Image.objects.filter(order=self.order, position__gte=10 * count).values_list('file', flat=True)),
+                names,
+            )
+            self.assertEqual(dict(Blob.objects.filter(name__in=names).values_list('name', 'references')),
+                             dict.fromkeys(names, 1))
+            schedule_variants.assert_called_once_with(set(names))
+
+    def test_same_content_shares_a_blob(self):
+        with mock.patch('app.images.schedule_variants') as schedule_variants, \
+                self.captureOnCommitCallbacks(execute=True):
+            first, second, other = store_images(self.order, [self.photo(), self.photo(), self.picture()])
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(Image.objects.filter(file=first.file.name).count(), 2)
+        self.assertEqual(Blob.objects.get(name=first.file.name).references, 2)
+        self.assertEqual(Blob.objects.get(name=other.file.name).references, 1)
+        schedule_variants.assert_called_once_with({first.file.name, other.file.name})
+
+    def test_rendered_variants_are_reused(self):
+        rendered, = store_images(self.order, [self.photo()])
+        variants = {'thumbnail': self.storage.save('photo.thumbnail.webp', ContentFile(b'thumbnail'))}
+        Image.objects.filter(file=rendered.file.name).update(variants=variants)
+        Blob.objects.acquire(variants.values())
+
+        with mock.patch('app.images.schedule_variants') as schedule_variants, \
+                self.captureOnCommitCallbacks(execute=True):
+            image, = store_images(self.order, [self.photo()], position=1)
+        self.assertEqual(Image.objects.get(position=1).variants, variants)
+        self.assertEqual(image.file.name, rendered.file.name)
+        self.assertEqual(Blob.objects.get(name=variants['thumbnail']).references, 2)
+        schedule_variants.assert_called_once_with(set())
+
+
+class OrderWriteTestCase(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='importer')
+        cls.category = Category.objects.create(name='Category')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def post(self, body, content_type='application/x-ndjson'):
+        return self.client.post('/api/orders/import/', body, content_type=content_type)
+
+    def row(self, title):
+        return '{"title": "%s", "description": "Description", "price": 10, "category": %s}\n' % (
+            title, self.category.pk)
+
+
+class OrderImportTests(OrderWriteTestCase):
+
+    def test_import(self):
+        response = self.post((self.row('Первый') + 'not json\n' + self.row('Second')).encode())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['errors'], [{'row': 2, 'errors': {'detail': ['Invalid JSON object.']}}])
+
+    def test_empty_body(self):
+        response = self.post(b'')
+        self.assertEqual(response.status_code, 400, response.content)
+
+    def test_body_that_is_not_utf8(self):
+        body = (self.row('First') * 600 + self.row('Последний')).encode('cp1251')
+        for content_type in ('application/x-ndjson', 'text/csv'):
+            with self.subTest(content_type):
+                response = self.post(body, content_type)
+                self.assertEqual(response.status_code, 400, response.content)
+        # nothing is imported, not even the chunks before the undecodable line
+        self.assertFalse(Order.objects.exists())
+
+
+class InboxStateTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.producer = User.objects.create(username='producer')
+        cls.consumer = User.objects.create(username='consumer')
+        cls.outsider = User.objects.create(username='outsider')
+        order = Order.objects.create(title='Order', description='Description', author=cls.producer, price=1,
+                                     category=Category.objects.create(name='Category'))
+        cls.chat = Chat.objects.create(order=order, producer=cls.producer, consumer=cls.consumer)
+
+    def send(self, *senders):
+        Message.objects.bulk_create(
+            Message(chat=self.chat, sender=sender, text='Text', message_type=Message.MessageTypes.TEXT.value)
+            for sender in senders
+        )
+        Chat.objects.record_messages(Message.objects.filter(chat=self.chat).order_by('-id')[:len(senders)])
+
+    def inbox(self, user):
+        self.client.force_authenticate(user)
+        chat, = self.get('/api/chats/').data['results']
+        return chat['unread'], chat['last_read_message']
+
+    def test_messages_are_unread_for_the_other_member(self):
+        self.send(self.producer, self.producer, self.consumer)
+        chat = Chat.objects.get()
+        self.assertEqual((chat.producer_unread, chat.consumer_unread), (1, 2))
+        self.assertEqual(chat.last_message, Message.objects.latest('id'))
+        self.assertEqual(self.inbox(self.producer), (1, None))
+        self.assertEqual(self.inbox(self.consumer), (2, None))
+
+    def test_mark_read(self):
+        self.send(self.producer, self.consumer)
+        self.client.force_authenticate(self.consumer)
+        self.assertEqual(self.client.post('/api/chats/%s/read/' % self.chat.pk).status_code, 204)
+        last = Message.objects.latest('id').pk
+        self.assertEqual(self.inbox(self.consumer), (0, last))
+        self.assertEqual(self.inbox(self.producer), (1, None))
+        self.send(self.producer)
+        self.assertEqual(self.inbox(self.consumer), (1, last))
+
+    def test_only_members_mark_read(self):
+        self.send(self.producer)
+        self.client.force_authenticate(self.outsider)
+        for chat_id in (self.chat.pk, self.chat.pk + 1):
+            self.assertEqual(self.client.post('/api/chats/%s/read/' % chat_id).status_code, 404)
+        self.assertEqual(Chat.objects.values_list('producer_unread', 'consumer_unread').get(), (0, 1))
+
+
+class TranscriptTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.ids = seed_page()
+        cls.chat = Chat.objects.get(pk=cls.ids['chat'])
+        cls.others = Chat.objects.create(order=cls.chat.order, producer=cls.chat.producer,
+                                         consumer=User.objects.create(username='other'))
+        Message.objects.create(chat=cls.others, sender=cls.chat.producer, text='Private',
+                               message_type=Message.MessageTypes.TEXT.value)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def download(self, url, content_type):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], content_type)
+        return response['Content-Disposition'], b''.join(response.streaming_content)
+
+    def expected(self, chat):
+        messages = chat.message_set.order_by('created_at', 'id')
+        return [dict(message, chat=chat.pk) for message in MessageListSerializer(messages, many=True).data]
+
+    def test_outputs(self):
+        url = '/api/chats/%s/transcript/' % self.chat.pk
+        disposition, ndjson = self.download(url, 'application/x-ndjson')
+        self.assertEqual(disposition, 'attachment; filename="chat-%s.ndjson"' % self.chat.pk)
+        self.assertEqual([json.loads(line) for line in ndjson.decode().splitlines()], self.expected(self.chat))
+        _, array = self.download(url + '?output=json', 'application/json')
+        self.assertEqual(json.loads(array), self.expected(self.chat))
+        disposition, compressed = self.download(url + '?output=json&compress=gzip', 'application/gzip')
+        self.assertEqual(disposition, 'attachment; filename="chat-%s.json.gz"' % self.chat.pk)
+        self.assertEqual(gzip.decompress(compressed), array)
+        self.assertEqual(self.client.get(url + '?output=xml').status_code, 400)
+
+    def test_empty_chat(self):
+        empty = Chat.objects.for_member(self.user).exclude(pk=self.chat.pk).first()
+        _, array = self.download('/api/chats/%s/transcript/?output=json' % empty.pk, 'application/json')
+        self.assertEqual(json.loads(array), [])
+
+    def test_members_only(self):
+        self.assertEqual(self.client.get('/api/chats/%s/transcript/' % self.others.pk).status_code, 404)
+        _, ndjson = self.download('/api/chats/transcript/', 'application/x-ndjson')
+        records = [json.loads(line) for line in ndjson.decode().splitlines()]
+        self.assertEqual(records, self.expected(self.chat))
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/chats/%s/transcript/' % self.chat.pk).status_code, 401)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'transcript.ndjson.gz')
+            call_command('export_chat_transcript', chat=[self.chat.pk], gzip=True, file=path, stdout=StringIO())
+            with gzip.open(path) as file:
+                self.assertEqual([json.loads(line) for line in file], self.expected(self.chat))
+        stdout = mock.Mock(buffer=BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            call_command('export_chat_transcript', user=self.others.consumer_id, output='json')
+        self.assertEqual(json.loads(stdout.buffer.getvalue()), self.expected(self.others))
+        with self.assertRaises(CommandError):
+            call_command('export_chat_transcript')
+
+
+class IdempotentCreateTests(OrderWriteTestCase):
+
+    def create(self, key='retried', **data):
+        data = dict({'title': 'Order', 'description': 'Description', 'price': 10, 'category': self.category.pk}, **data)
+        return self.client.post('/api/orders/', data, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_is_replayed(self):
+        created = self.create()
+        self.assertEqual(created.status_code, 201, created.content)
+        retried = self.create()
+        self.assertEqual((retried.status_code, retried['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(retried.data['id'], created.data['id'])
+        self.assertEqual(Order.objects.filter(author=self.user).count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        self.create()
+        self.assertEqual(self.create(title='Other').status_code, 422)
+        self.assertEqual(Order.objects.filter(author=self.user).count(), 1)
+
+    def test_retry_while_in_flight(self):
+        retries = []
+
+        def retry_first(view, serializer):
+            retries.append(self.create())
+            serializer.save()
+
+        with mock.patch.object(OrderViewSet, 'perform_create', retry_first):
+            self.assertEqual(self.create().status_code, 201)
+        self.assertEqual(retries[0].status_code, 409)
+
+    def test_client_errors_release_the_key(self):
+        for _ in range(2):
+            response = self.create(price='')
+            self.assertEqual(response.status_code, 400)
+            self.assertNotIn('Idempotent-Replayed', response)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        class RefusingView(APIView):
+            @idempotent
+            def post(self, request):
+                return Response({'detail': 'Refused.'}, status=400)
+
+        request = APIRequestFactory().post('/refused/', {}, format='json', HTTP_IDEMPOTENCY_KEY='refused')
+        force_authenticate(request, self.user)
+        self.assertEqual(RefusingView.as_view()(request).status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_claim_after_the_key_was_released(self):
+        save = IdempotencyKey.save
+        inserts = []
+
+        def insert(record, *args, **kwargs):
+            inserts.append(record)
+            if len(inserts) == 1:
+                # the row this insert conflicted with is gone before it is looked up
+                raise IntegrityError('idempotency_user_key_uniq')
+            return save(record, *args, **kwargs)
+
+        with mock.patch.object(IdempotencyKey, 'save', insert):
+            record, claimed = claim(self.user.pk, key_digest('http', 'released'), 'fingerprint')
+        self.assertTrue(claimed)
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(IdempotencyKey.objects.get().pk, record.pk)
+
+
+class OrderSideEffectTests(OrderWriteTestCase):
+    """
+    Saves, bulk status changes and imports leave the same counters, search documents and caches
+    """
+
+    def stats(self):
+        return AuthorStats.objects.filter(user=self.user).values_list('order_count', 'active_order_count').get()
+
+    def user_orders(self):
+        return [order['title'] for order in self.get('/api/user/orders/').data['results']]
+
+    def search(self, terms):
+        return [order['title'] for order in self.get('/api/orders/?search=%s' % terms).data['results']]
+
+    def test_paths_agree(self):
+        Order.objects.create(title='Saved', description='Description', author=self.user, price=1,
+                             category=self.category)
+        self.assertEqual(self.stats(), (1, 1))
+        self.assertEqual(self.user_orders(), ['Saved'])
+
+        self.post(self.row('Imported').encode())
+        self.assertEqual(self.stats(), (2, 2))
+        self.assertEqual(self.user_orders(), ['Imported', 'Saved'])
+        self.assertEqual(self.search('Imported'), ['Imported'])
+
+        self.assertEqual(set_orders_active(self.user, Order.objects.values_list('pk', flat=True), False), 2)
+        self.assertEqual(self.stats(), (2, 0))
+        self.assertEqual([order['is_active'] for order in self.get('/api/user/orders/').data['results']],
+                         [False, False])
+
+        AuthorStats.objects.recount([self.user.pk])
+        self.assertEqual(self.stats(), (2, 0))
+
+
+class OrderStatusTests(OrderWriteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.orders = [
+            Order.objects.create(title='Order %s' % index, description='Description', author=self.user, price=1,
+                                 category=self.category)
+            for index in range(2)
+        ]
+        self.others = Order.objects.create(title='Other', description='Description', price=1,
+                                           author=User.objects.create(username='other'), category=self.category)
+
+    def stats(self, user):
+        return AuthorStats.objects.filter(user=user).values_list('order_count', 'active_order_count').get()
+
+    def switch(self, pk, is_active=False):
+        return self.client.post('/api/orders/%s/switch/' % pk, {'is_active': is_active}, format='json')
+
+    def test_switch(self):
+        order = self.orders[0]
+        for _ in range(2):
+            response = self.switch(order.pk)
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(response.data, {'id': order.pk, 'is_active': False})
+        self.assertEqual(self.stats(self.user), (2, 1))
+        for pk in (self.others.pk, self.others.pk + 1, 'first'):
+            with self.subTest(pk):
+                self.assertEqual(self.switch(pk).status_code, 404)
+        self.assertTrue(Order.objects.get(pk=self.others.pk).is_active)
+
+    def test_bulk_status(self):
+        ids = [order.pk for order in self.orders] + [self.others.pk]
+        for updated in (2, 0):
+            response = self.client.post('/api/orders/status/', {'ids': ids, 'is_active': False}, format='json')
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(response.data, {'updated': updated})
+        self.assertEqual(self.stats(self.user), (2, 0))
+        self.assertEqual(self.stats(self.others.author), (1, 1))
+        AuthorStats.objects.recount([self.user.pk, self.others.author_id])
+        self.assertEqual(self.stats(self.user), (2, 0))
+        self.assertEqual(self.stats(self.others.author), (1, 1))
+
+        response = self.client.post('/api/orders/status/', {'ids': ids[:1], 'is_active': True}, format='json')
+        self.assertEqual(response.data, {'updated': 1})
+        self.assertEqual(self.stats(self.user), (2, 1))
+
+
+class ConditionalGetTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.ids = seed_page()
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def assertChangedBy(self, url, change):
+        url = url.format(**self.ids)
+        etag = self.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        change()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_category_rename(self):
+        def rename():
+            category = Order.objects.get(pk=self.ids['order']).category
+            category.name = 'Renamed'
+            category.save()
+
+        for url in ('/api/orders/', '/api/orders/{order}/'):
+            with self.subTest(url):
+                self.assertChangedBy(url, rename)
+
+    def test_author_rename(self):
+        def rename():
+            author = User.objects.get(pk=self.ids['commented'])
+            author.first_name = 'Renamed'
+            author.save()
+
+        for url in ('/api/orders/', '/api/orders/{order}/', '/api/chats/{chat}/messages/'):
+            with self.subTest(url):
+                self.assertChangedBy(url, rename)
+
+    def test_facets_ignore_annotations(self):
+        # search ranks rows with an annotation, the counts must not be split by it
+        data = self.get('/api/orders/?facets=1&search=Order').data
+        self.assertEqual(sum(category['count'] for category in data['facets']['categories']), data['count'])
+        self.assertEqual(sum(bucket['count'] for bucket in data['facets']['price']), data['count'])
+
+
+class CachedResponseTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.ids = seed_page()
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_not_modified_from_the_cache(self):
+        for url in ('/api/categories/', '/api/authors/', '/api/user/orders/'):
+            with self.subTest(url):
+                response = self.get(url)
+                with self.assertNumQueries(0):
+                    cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(cached.status_code, 304)
+                self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_writes_invalidate(self):
+        order = Order.objects.filter(author=self.user).first()
+        for url, change in (
+            ('/api/categories/', lambda: Category.objects.create(name='New category')),
+            ('/api/user/orders/', lambda: Order.objects.create(
+                title='New order', description='Description', author=self.user, price=1, category=order.category)),
+            ('/api/authors/%s/' % self.ids['commented'], lambda: Comment.objects.create(
+                user_id=self.ids['commented'], author=self.user, message='New comment')),
+        ):
+            with self.subTest(url):
+                before = self.get(url)
+                change()
+                after = self.client.get(url, HTTP_IF_NONE_MATCH=before['ETag'])
+                self.assertEqual(after.status_code, 200)
+                self.assertNotEqual(after.data, before.data)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class RecomputeLockTests(SimpleTestCase):
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+
+        def compute():
+            calls.append(threading.get_ident())
+            time.sleep(0.2)
+            return 'value'
+
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: get_or_compute('key', compute, 60), range(4)))
+        self.assertEqual(results, ['value'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(get_cache().get('key:lock'))
+
+    def test_waiters_give_up_after_the_lock_timeout(self):
+        # a worker holding the lock died before storing its value
+        get_cache().add('key:lock', 1)
+        with override_settings(RESOURCE_CACHE=dict(settings.RESOURCE_CACHE, LOCK_TIMEOUT=0.1)):
+            self.assertEqual(get_or_compute('key', lambda: 'value', 60), 'value')
+
+
+class BlobCollectionTests(MediaTestCase):
+    """
+    Files of deleted images are removed once the delete is committed, unless they are still referenced
+    or were touched too recently to rule out an upload reusing them
+    """
+
+    def test_deleted_image_file_is_removed(self):
+        store_images(self.order, [self.picture((1, 1)), self.picture((2, 2))])
+        kept, deleted = self.order.image_set.all()
+        self.age(deleted.file.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            update_images(self.order, [kept.pk], [])
+
+        self.assertEqual(list(self.order.image_set.all()), [kept])
+        self.assertFalse(self.storage.exists(deleted.file.name))
+        self.assertFalse(Blob.objects.filter(name=deleted.file.name).exists())
+        self.assertTrue(self.storage.exists(kept.file.name))
+
+    def test_shared_and_recent_files_are_kept(self):
+        store_images(self.order, [self.picture((1, 1)), self.picture((1, 1)), self.picture((2, 2))])
+        first, second, recent = self.order.image_set.all()
+        self.age(first.file.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            update_images(self.order, [second.pk], [])
+
+        self.assertTrue(self.storage.exists(first.file.name))
+        self.assertEqual(Blob.objects.get(name=first.file.name).references, 1)
+        self.assertTrue(self.storage.exists(recent.file.name))
+        self.assertEqual(Blob.objects.get(name=recent.file.name).references, 0)
+
+    def test_query_count_does_not_grow_with_deleted_images(self):
+        for count in (1, 4):
+            order = Order.objects.create(title='Order', description='Description', author=self.user, price=1,
+                                         category=self.order.category)
+            kept, *deleted = store_images(order, [self.picture((count, size)) for size in range(1, count + 2)])
+            keep_ids = [Image.objects.get(order=order, position=0).pk]
+            for image in deleted:
+                self.age(image.file.name)
+            # select, delete, release
+            with self.assertNumQueries(3), self.captureOnCommitCallbacks() as callbacks:
+                update_images(order, keep_ids, [])
+            self.assertEqual(len(callbacks), 1)
+            # savepoint, locked select, delete, release savepoint
+            with self.assertNumQueries(4):
+                callbacks[0]()
+            self.assertFalse(Blob.objects.filter(name__in=[image.file.name for image in deleted]).exists())
+            self.assertFalse(any(self.storage.exists(image.file.name) for image in deleted))
+            self.assertTrue(self.storage.exists(kept.file.name))
+
+    def test_order_delete(self):
+        image, = store_images(self.order, [self.picture()])
+        self.age(image.file.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.delete()
+        self.assertFalse(self.storage.exists(image.file.name))
+
+
+class MediaGarbageTests(MediaTestCase):
+
+    def store(self, name, aged=True):
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(b'content')
+        if aged:
+            self.age(name)
+        return name
+
+    def test_only_old_orphaned_blobs_are_deleted(self):
+        orphan = self.store('blobs/aa/bb/orphan.png')
+        recent = self.store('blobs/aa/bb/recent.png', aged=False)
+        others = [self.store('tmp/upload'), self.store('avatars/user.png')]
+        store_images(self.order, [self.picture()])
+        referenced = Image.objects.get().file.name
+        self.age(referenced)
+
+        call_command('collect_media_garbage', stdout=StringIO())
+        self.assertFalse(self.storage.exists(orphan))
+        for name in (recent, referenced, *others):
+            self.assertTrue(self.storage.exists(name), name)
+
+
+class ChatCreateTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.producer = User.objects.create(username='producer')
+        cls.consumer = User.objects.create(username='consumer')
+        cls.order = Order.objects.create(title='Order', description='Description', author=cls.producer, price=1,
+                                         category=Category.objects.create(name='Category'))
+
+    def test_retries_return_the_same_chat(self):
+        self.client.force_authenticate(self.consumer)
+        data = {'order': self.order.pk, 'producer': self.producer.pk, 'consumer': self.consumer.pk}
+        # membership checks cached before the chat existed are forgotten by the post_save signal
+        with mock.patch('chat_consumer.signals.forget_membership') as forget_membership:
+            created = self.client.post('/api/chats/', data)
+        self.assertEqual(created.status_code, 201, created.content)
+        forget_membership.assert_called_once_with(Chat.objects.get())
+        self.assertTrue(async_to_sync(is_chat_member)(self.consumer.pk, created.data['id']))
+        again = self.client.post('/api/chats/', data)
+        self.assertEqual(again.status_code, 200, again.content)
+        self.assertEqual(again.data['id'], created.data['id'])
+        self.assertEqual(Chat.objects.count(), 1)
+
+    def test_lost_race_reads_the_existing_chat(self):
+        Chat.objects.create(order=self.order, producer=self.producer, consumer=self.consumer)
+        lookups = []
+        get = ChatQuerySet.get
+
+        def miss_first(queryset, *args, **kwargs):
+            # the chat is committed by another request between the lookup and the insert
+            lookups.append(kwargs)
+            if len(lookups) == 1:
+                raise Chat.DoesNotExist
+            return get(queryset, *args, **kwargs)
+
+        self.client.force_authenticate(self.consumer)
+        data = {'order': self.order.pk, 'producer': self.producer.pk, 'consumer': self.consumer.pk}
+        with mock.patch.object(ChatQuerySet, 'get', miss_first):
+            response = self.client.post('/api/chats/', data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['id'], Chat.objects.get().pk)
+        self.assertEqual(len(lookups), 2)
+
+
+class ViewerChatTests(APITestCase):
+    """
+    The chat of the viewer annotated on each order in the list and detail endpoints
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.producer = User.objects.create(username='producer')
+        cls.consumer = User.objects.create(username='consumer')
+        cls.outsider = User.objects.create(username='outsider')
+        cls.order = Order.objects.create(title='Order', description='Description', author=cls.producer, price=1,
+                                         category=Category.objects.create(name='Category'))
+        cls.first = Chat.objects.create(order=cls.order, producer=cls.producer, consumer=cls.consumer)
+        Chat.objects.create(order=cls.order, producer=cls.consumer, consumer=cls.producer)
+        Chat.objects.create(order=cls.order, producer=cls.producer, consumer=cls.outsider)
+
+    def test_annotation(self):
+        viewer_chats = {
+            user: Order.objects.with_viewer_chat(user).get(pk=self.order.pk).viewer_chat_id
+            for user in (self.producer, self.consumer, User.objects.create(username='stranger'))
+        }
+        self.assertEqual(list(viewer_chats.values()), [self.first.pk, self.first.pk, None])
+
+    def test_endpoints(self):
+        outsider_chat = Chat.objects.get(consumer=self.outsider).pk
+        for user, chat in ((self.consumer, self.first.pk), (self.outsider, outsider_chat)):
+            self.client.force_authenticate(user)
+            self.assertEqual(self.get('/api/orders/').data['results'][0]['chat'], chat)
+            self.assertEqual(self.get('/api/orders/%s/' % self.order.pk).data['chat'], chat)
+        self.client.force_authenticate(User.objects.create(username='stranger'))
+        self.assertIsNone(self.get('/api/orders/').data['results'][0]['chat'])
+        self.assertIsNone(self.get('/api/orders/%s/' % self.order.pk).data['chat'])
@@ -0,0 +1,67 @@
+import json
+import zlib
+
+from django.conf import settings
+
+from app.models import Message
+
+FIELDS = ('id', 'chat', 'sender', 'sender__first_name', 'sender__last_name', 'text', 'message_type', 'created_at')
+
+
+def transcript_messages(chat_ids):
+    """
+    Messages of some chats in transcript order, (chat, created_at, id) follows message_chat_created_idx
+    """
+
+    return Message.objects.filter(chat__in=chat_ids).order_by('chat', 'created_at', 'id')
+
+
+def transcript_records(messages):
+    """
+    Flat values() rows shaped like MessageListSerializer output plus the chat id,
+    fetched through a server-side cursor so memory does not grow with the chat
+    """
+
+    rows = messages.values_list(*FIELDS).iterator(chunk_size=settings.CHAT_TRANSCRIPT['CHUNK_SIZE'])
+    for pk, chat, sender, first_name, last_name, text, message_type, created_at in rows:
+        created_at = created_at.isoformat()
+        if created_at.endswith('+00:00'):
+            created_at = created_at[:-6] + 'Z'
+        yield {
+            'id': pk,
+            'chat': chat,
+            'text': text,
+            'sender': {'id': sender, 'first_name': first_name, 'last_name': last_name},
+            'message_type': message_type,
+            'created_at': created_at,
+        }
+
+
+def transcript_chunks(messages, output='ndjson'):
+    """
+    Encoded pieces of an NDJSON (one message per line) or JSON (one array) transcript
+    """
+
+    records = transcript_records(messages)
+    if output == 'ndjson':
+        for record in records:
+            yield (json.dumps(record) + '\n').encode()
+        return
+    separator = b'[\n'
+    for record in records:
+        yield separator + json.dumps(record).encode()
+        separator = b',\n'
+    yield b'[]\n' if separator == b'[\n' else b'\n]\n'
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compress a stream of bytes on the fly into one gzip member
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
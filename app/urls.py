@@ -16,4 +16,5 @@ urlpatterns = [
     path('authors/', AuthorListAPIView.as_view()),
     path('authors/<int:pk>/', AuthorRetrieveAPIView.as_view()),
     path('user/orders/', UserOrderAPIView.as_view()),
+    path('user/orders/export/', UserOrderExportAPIView.as_view()),
 ] + router.urls
@@ -1,32 +1,45 @@
 from django.contrib.auth.models import User
-from django.http import Http404
-from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
+from django.db.models import F, Q
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import generics, viewsets, status
 from rest_framework.decorators import action
-from rest_framework.filters import OrderingFilter, SearchFilter
-from rest_framework.parsers import MultiPartParser
+from rest_framework.exceptions import UnsupportedMediaType
+from rest_framework.filters import OrderingFilter
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 
-from app.filters import OrderPriceFilter
+from app.facets import order_facets
+from app.filters import OrderPriceFilter, OrderSearchFilter
+from app.idempotency import idempotent
 from app.models import Order, Category, Comment, Chat, Message
+from app.orders import export_orders, import_orders, read_rows, set_orders_active
 from app.serializers import (
+    BulkOrderStatusSerializer,
     ChangePasswordSerializer,
     OrderRetrieveSerializer,
+    OrderChatListSerializer,
     CommentListSerializer,
     UpdateOrderSerializer,
     MessageListSerializer,
     CreateOrderSerializer,
     CreateChatSerializer,
+    OrderStatusSerializer,
     OrderListSerializer,
     ChatListSerializer,
-    UserListSerializer,
     CategorySerializer,
     CommentSerializer,
+    AuthorSerializer,
     SignUpSerializer,
     UserSerializer,
 )
+from app.transcripts import gzip_chunks, transcript_chunks, transcript_messages
+from core.cache import CachedResponseMixin
+from core.compiled import CompiledListMixin
+from core.conditional import ConditionalGetMixin
+from core.pagination import KeysetPagination, OrderingKeysetPagination
+from core.prefetch import QueryPlanMixin
 
 
 class UserAPIView(generics.RetrieveUpdateAPIView):
@@ -42,9 +55,11 @@ class SignUpAPIView(generics.CreateAPIView):
     permission_classes = (AllowAny,)
 
 
-class ChatViewSet(viewsets.ModelViewSet):
+class ChatViewSet(ConditionalGetMixin, QueryPlanMixin, CompiledListMixin, viewsets.ModelViewSet):
+    queryset = Chat.objects.all()
     serializer_class = ChatListSerializer
     permission_classes = (IsAuthenticated,)
+    stamp_resources = ('users',)
 
     serializer = {
         'list': ChatListSerializer,
@@ -52,21 +67,77 @@ class ChatViewSet(viewsets.ModelViewSet):
         'create': CreateChatSerializer,
         'chat_messages': MessageListSerializer
     }
+    transcript_content_types = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
 
     def get_serializer_class(self):
         return self.serializer.get(self.action, CreateChatSerializer)
 
     def get_queryset(self):
-        return Chat.objects.filter(
-            Q(producer=self.request.user) | Q(consumer=self.request.user)
-        ).order_by('-created_at')
+        # annotated before planning so the plan can restrict the columns to what is rendered
+        chats = self.queryset.all().for_member(self.request.user).with_viewer_state(self.request.user)
+        return self.plan_queryset(chats.order_by('-last_activity_at', '-id'))
 
-    @action(methods=('get',), url_path='messages', detail=True)
+    def create(self, request, *args, **kwargs):
+        """
+        Get or create the chat of an order between two users, retries return the same chat
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        # an insert losing the race against chat_order_members_uniq reads the winner's chat
+        chat, created = Chat.objects.get_or_create(**serializer.validated_data)
+        return Response(
+            self.get_serializer(chat).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+    @action(methods=('get',), url_path='transcript', detail=True)
+    def transcript(self, request, pk):
+        """
+        Stream every message of the chat, ?output=ndjson|json and ?compress=gzip
+        """
+
+        if not Chat.objects.for_member(request.user).filter(pk=pk).exists():
+            raise Http404
+        return self.transcript_response(request, [pk], 'chat-%s' % pk)
+
+    @action(methods=('get',), url_path='transcript', detail=False)
+    def transcripts(self, request):
+        """
+        Stream the messages of all of the user's chats, grouped by chat
+        """
+
+        return self.transcript_response(request, Chat.objects.for_member(request.user).values('id'), 'chats')
+
+    def transcript_response(self, request, chat_ids, name):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in self.transcript_content_types:
+            return Response({'output': ['Expected one of: %s.' % ', '.join(self.transcript_content_types)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        chunks = transcript_chunks(transcript_messages(chat_ids), output)
+        content_type = self.transcript_content_types[output]
+        filename = '%s.%s' % (name, output)
+        if request.query_params.get('compress') == 'gzip':
+            chunks, content_type, filename = gzip_chunks(chunks), 'application/gzip', filename + '.gz'
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
+    @action(methods=('post',), url_path='read', detail=True)
+    def mark_read(self, request, pk):
+        """
+        Mark every message of the chat as read by the current user
+        """
+
+        if not Chat.objects.mark_read(pk, request.user.pk):
+            raise Http404
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(methods=('get',), url_path='messages', detail=True, pagination_class=KeysetPagination)
     def chat_messages(self, request, pk):
-        messages = Message.objects.filter(chat_id=pk).order_by('-created_at')
-        page = self.paginate_queryset(messages)
-        serializer = self.get_serializer(page, many=True)
-        return self.get_paginated_response(serializer.data)
+        messages = self.plan_queryset(Message.objects.filter(chat_id=pk).order_by('-created_at'))
+
+        return self.conditional_response(request, (messages,), lambda: self.paginated_response(messages))
 
 
 class ChangePasswordAPIView(generics.UpdateAPIView):
@@ -78,41 +149,85 @@ class ChangePasswordAPIView(generics.UpdateAPIView):
         return self.request.user
 
 
-class CategoryAPIView(generics.ListAPIView):
+class CategoryAPIView(CachedResponseMixin, generics.ListAPIView):
+    cache_resource = 'categories'
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = (IsAuthenticated,)
     pagination_class = None
 
 
-class AuthorListAPIView(generics.ListAPIView):
-    queryset = User.objects.all()
-    serializer_class = UserListSerializer
+class AuthorListAPIView(CachedResponseMixin, QueryPlanMixin, generics.ListAPIView):
+    cache_resource = 'authors'
+    # counters are read from the joined AuthorStats row, ordering by them never aggregates
+    queryset = User.objects.filter(stats__isnull=False).annotate(
+        comment_count=F('stats__comment_count'),
+        order_count=F('stats__order_count'),
+        active_order_count=F('stats__active_order_count'),
+        last_activity_at=F('stats__last_activity_at'),
+    )
+    serializer_class = AuthorSerializer
     permission_classes = (IsAuthenticated,)
-    pagination_class = None
+    pagination_class = OrderingKeysetPagination
+    filter_backends = [OrderingFilter]
+    ordering_fields = ['comment_count', 'order_count', 'active_order_count', 'last_activity_at']
+    ordering = ['-comment_count']
 
 
-class AuthorRetrieveAPIView(generics.RetrieveAPIView):
-    queryset = User.objects.all()
-    serializer_class = UserListSerializer
+class AuthorRetrieveAPIView(CachedResponseMixin, QueryPlanMixin, generics.RetrieveAPIView):
+    cache_resource = 'authors'
+    queryset = AuthorListAPIView.queryset
+    serializer_class = AuthorSerializer
     permission_classes = (IsAuthenticated,)
 
 
-class UserOrderAPIView(generics.ListAPIView):
+class UserOrderAPIView(CachedResponseMixin, QueryPlanMixin, CompiledListMixin, generics.ListAPIView):
+    cache_resource = 'user_orders'
     queryset = Order.objects.filter()
     serializer_class = OrderListSerializer
     permission_classes = (IsAuthenticated,)
-    filter_backends = [DjangoFilterBackend, OrderingFilter, SearchFilter, OrderPriceFilter]
-    search_fields = ['title']
+    pagination_class = KeysetPagination
+    filter_backends = [DjangoFilterBackend, OrderingFilter, OrderPriceFilter, OrderSearchFilter]
     filter_fields = ['title', 'category']
     ordering_fields = ['created_at', 'title']
     ordering = ['-created_at']
 
     def get_queryset(self):
-        return self.queryset.filter(author=self.request.user)
+        return super().get_queryset().filter(author=self.request.user)
+
+    def get_cache_identifier(self):
+        return self.request.user.pk
+
+
+class UserOrderExportAPIView(generics.GenericAPIView):
+    """
+    Streams the user's orders as NDJSON (default) or CSV with ?output=csv,
+    filters and ordering are the ones of the user's order list
+    """
+
+    queryset = Order.objects.all()
+    permission_classes = (IsAuthenticated,)
+    filter_backends = UserOrderAPIView.filter_backends
+    filter_fields = UserOrderAPIView.filter_fields
+    ordering_fields = UserOrderAPIView.ordering_fields
+    ordering = UserOrderAPIView.ordering
+    content_types = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+    def get_queryset(self):
+        return super().get_queryset().filter(author=self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in self.content_types:
+            return Response({'output': ['Expected one of: %s.' % ', '.join(self.content_types)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        orders = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(export_orders(orders, output), content_type=self.content_types[output])
+        response['Content-Disposition'] = 'attachment; filename="orders.%s"' % output
+        return response
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     filter_backends = [DjangoFilterBackend, OrderingFilter]
     ordering = ['-created_at']
@@ -120,41 +235,48 @@ class CategoryViewSet(viewsets.ModelViewSet):
     serializer = {
         'list': CommentListSerializer,
         'create': CommentSerializer,
+        'user': CommentListSerializer,
     }
 
-    @action(methods=('get',), detail=True)
+    @action(methods=('get',), detail=True, pagination_class=KeysetPagination)
     def user(self, request, pk):
-        try:
-            user_comments = self.get_queryset().filter(
-                user_id=pk
-            ).order_by('-created_at')
-        except Http404:
-            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
-        serializer = CommentListSerializer(user_comments, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        """
+        Comments left about a user, newest first, one page per request
+        """
+
+        comments = self.plan_queryset(Comment.objects.filter(user_id=pk).order_by('-created_at', '-id'))
+        page = self.paginate_queryset(comments)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     def get_serializer_class(self):
         return self.serializer.get(self.action, CreateOrderSerializer)
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, QueryPlanMixin, CompiledListMixin, viewsets.ModelViewSet):
     parser_classes = (MultiPartParser,)
     queryset = Order.objects.filter(is_active=True)
     permission_classes = (IsAuthenticated,)
     serializer_class = CreateOrderSerializer
-    filter_backends = [DjangoFilterBackend, OrderingFilter, OrderPriceFilter, SearchFilter]
-    search_fields = ['title']
+    # only numeric ids are routed, the status actions hand pk to set_orders_active and int() as is
+    lookup_value_regex = r'\d+'
+    pagination_class = KeysetPagination
+    filter_backends = [DjangoFilterBackend, OrderingFilter, OrderPriceFilter, OrderSearchFilter]
     filter_fields = ['title', 'author', 'price', 'category']
     ordering_fields = ['created_at', 'price', 'title']
     ordering = ['-created_at']
+    stamp_resources = ('categories', 'users')
 
     serializer = {
-        'list': OrderListSerializer,
+        'list': OrderChatListSerializer,
         'create': CreateOrderSerializer,
         'retrieve': OrderRetrieveSerializer,
-        'update': UpdateOrderSerializer
+        'update': UpdateOrderSerializer,
+        'switch_order_status': OrderStatusSerializer,
+        'bulk_status': BulkOrderStatusSerializer,
     }
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         file_fields = list(request.FILES.keys())
         serializer = self.get_serializer(data=request.data, file_fields=file_fields)
@@ -172,21 +294,80 @@ class OrderViewSet(viewsets.ModelViewSet):
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    def list(self, request, *args, **kwargs):
+        """
+        ?facets=1 adds order counts per category and price bucket for the current filters
+        """
+
+        orders = self.filter_queryset(self.get_queryset())
+
+        def render():
+            response = self.paginated_response(orders)
+            if request.query_params.get('facets'):
+                response.data['facets'] = order_facets(orders)
+            return response
+
+        return self.conditional_response(request, (orders, self.viewer_chats()), render)
+
+    def retrieve(self, request, *args, **kwargs):
+        render = super().retrieve
+        return self.conditional_response(
+            request,
+            (Order.objects.filter(pk=kwargs['pk']), self.viewer_chats().filter(order_id=kwargs['pk'])),
+            lambda: render(request, *args, **kwargs),
+        )
+
+    def get_queryset(self):
+        return self.plan_queryset(self.queryset.all().with_viewer_chat(self.request.user))
+
+    def viewer_chats(self):
+        return Chat.objects.filter(Q(producer=self.request.user) | Q(consumer=self.request.user))
+
     def get_object(self):
-        order = Order.objects.get(pk=self.kwargs['pk'])
+        order = self.plan_queryset(Order.objects.with_viewer_chat(self.request.user)).get(pk=self.kwargs['pk'])
         if not order.is_active and order.author != self.request.user:
             raise Order.DoesNotExist()
         return order
 
-    @action(methods=('get',), url_path='switch', detail=True)
+    @action(methods=('post',), url_path='import', detail=False)
+    def bulk_import(self, request):
+        """
+        Create the user's orders from an NDJSON (application/x-ndjson) or CSV (text/csv) body
+        Valid rows are created, the response lists the errors of the rejected ones
+        """
+
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type not in ('application/x-ndjson', 'text/csv'):
+            raise UnsupportedMediaType(content_type)
+        return Response(import_orders(request.user, read_rows(request.stream, content_type)))
+
+    @action(methods=('post',), url_path='switch', detail=True, parser_classes=(JSONParser, FormParser))
     def switch_order_status(self, request, pk):
-        try:
-            order = Order.objects.get(pk=pk)
-            order.is_active = not order.is_active
-            order.save()
-        except Http404:
-            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
-        return Response({'is_active': order.is_active}, status=status.HTTP_200_OK)
+        """
+        Move one of the user's orders to the requested is_active state, repeating it is harmless
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        is_active = serializer.validated_data['is_active']
+        if not set_orders_active(request.user, [pk], is_active):
+            # nothing changed, either the order is already in that state or it is not the user's
+            if not Order.objects.filter(pk=pk, author=request.user).exists():
+                raise Http404
+        return Response({'id': int(pk), 'is_active': is_active}, status=status.HTTP_200_OK)
+
+    @action(methods=('post',), url_path='status', detail=False, parser_classes=(JSONParser, FormParser))
+    def bulk_status(self, request):
+        """
+        Activate or deactivate many of the user's orders in one statement
+        Ids of other users' orders are ignored
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        updated = set_orders_active(
+            request.user, serializer.validated_data['ids'], serializer.validated_data['is_active'])
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
 
     def get_serializer_class(self):
         return self.serializer.get(self.action, CreateOrderSerializer)
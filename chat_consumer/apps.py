@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChatConsumerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat_consumer'
+
+    def ready(self):
+        import chat_consumer.signals  # noqa: F401
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import weakref
+from typing import List
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils import timezone
+
+from app.idempotency import expires_at, replayed
+from app.models import Chat, IdempotencyKey, Message
+from app.serializers import MessageListSerializer
+from core.base_enum import BaseEnum
+
+logger = logging.getLogger(__name__)
+
+
+class Durability(BaseEnum):
+    ACK = 'ack'
+    FIRE_AND_FORGET = 'fire_and_forget'
+
+
+class DuplicateMessage(Exception):
+    """
+    A message whose client_id was already written, response is the stored message
+    """
+
+    def __init__(self, response):
+        super().__init__('Message was already written')
+        self.response = response
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for chat messages
+    Messages are collected and written with a single bulk_create once either
+    max_size messages are pending or flush_interval seconds have passed,
+    a batch the database rejects is written again message by message
+    so only the futures of the rejected messages fail
+    Messages sent with a client_id are tracked by (sender, key) until they are committed,
+    and their keys are inserted in the same transaction without ignoring conflicts,
+    so a retry is never written twice, whether it is still pending or not
+    """
+
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._keys = {}
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def for_current_loop(cls) -> 'MessageBuffer':
+        """
+        One buffer is shared by every consumer running on the same event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        if loop not in cls._instances:
+            config = settings.CHAT_MESSAGE_BUFFER
+            cls._instances[loop] = cls(config['MAX_SIZE'], config['FLUSH_INTERVAL'])
+        return cls._instances[loop]
+
+    def pending(self, sender_id, key: str):
+        """
+        The message and future of a keyed message that is not committed yet, None when there is none
+        """
+
+        return self._keys.get((sender_id, key))
+
+    def add(self, message: Message) -> asyncio.Future:
+        """
+        Queue an unsaved message, the returned future resolves once it is committed
+        A message whose key is already pending gets the future of the pending one
+        """
+
+        key = getattr(message, 'idempotency_key', None)
+        if key and (message.sender_id, key) in self._keys:
+            return self._keys[message.sender_id, key][1]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(self._log_failure)
+        self._pending.append((message, future))
+        if key:
+            self._keys[message.sender_id, key] = message, future
+        if len(self._pending) >= self.max_size:
+            self._cancel_timer()
+            asyncio.ensure_future(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush_later)
+        return future
+
+    async def flush(self):
+        self._cancel_timer()
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        async with self._lock:
+            try:
+                failures = await database_sync_to_async(self.write)([message for message, _ in batch])
+            except Exception as exc:
+                failures = dict.fromkeys(range(len(batch)), exc)
+        for index, (message, future) in enumerate(batch):
+            key = getattr(message, 'idempotency_key', None)
+            if key:
+                self._keys.pop((message.sender_id, key), None)
+            if future.done():
+                continue
+            if index in failures:
+                future.set_exception(failures[index])
+            else:
+                future.set_result(message)
+
+    @classmethod
+    def write(cls, messages: List[Message]) -> dict:
+        """
+        Insert a batch, when it fails insert its messages one at a time
+        Returns the errors of the messages that were not saved by their index in the batch,
+        a message whose key was committed by an earlier batch fails with DuplicateMessage
+        """
+
+        if len(messages) > 1:
+            try:
+                cls.insert(messages)
+                return {}
+            except DatabaseError:
+                pass
+        failures = {}
+        for index, message in enumerate(messages):
+            try:
+                cls.insert([message])
+            except DatabaseError as exc:
+                failures[index] = exc
+                key = getattr(message, 'idempotency_key', None)
+                if key and isinstance(exc, IntegrityError):
+                    record = replayed(message.sender_id, key)
+                    if record is not None:
+                        failures[index] = DuplicateMessage(record.response)
+        return failures
+
+    @staticmethod
+    def insert(messages: List[Message]):
+        """
+        Insert messages and move the inbox state of their chats in the same transaction
+        Messages sent with a client_id are remembered so retries of them can be replayed
+        """
+
+        keyed = [message for message in messages if getattr(message, 'idempotency_key', None)]
+        with transaction.atomic():
+            if keyed:
+                # expired keys may be reused, the purge command may not have removed them yet
+                IdempotencyKey.objects.filter(
+                    user_id__in={message.sender_id for message in keyed},
+                    key__in={message.idempotency_key for message in keyed},
+                    expires_at__lte=timezone.now(),
+                ).delete()
+            Message.objects.bulk_create(messages)
+            Chat.objects.record_messages(messages)
+            # a key committed in the meantime fails the insert, and with it the messages
+            IdempotencyKey.objects.bulk_create([
+                IdempotencyKey(
+                    user_id=message.sender_id,
+                    key=message.idempotency_key,
+                    status_code=200,
+                    response=MessageListSerializer(message).data,
+                    expires_at=expires_at(),
+                )
+                for message in keyed
+            ])
+
+    def _flush_later(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None \
+                and not isinstance(future.exception(), DuplicateMessage):
+            logger.error('Failed to persist chat messages', exc_info=future.exception())
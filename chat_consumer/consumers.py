@@ -1,75 +1,328 @@
-import datetime
+import asyncio
 import json
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.utils import timezone
 
-from app.models import Message
-from app.serializers import MessageListSerializer
+from app.idempotency import key_digest, replayed
+from app.models import Chat, Message
+from app.serializers import MessageCreateSerializer, MessageListSerializer
+from chat_consumer.buffer import DuplicateMessage, Durability, MessageBuffer
+from chat_consumer.membership import is_chat_member
+from chat_consumer.presence import PresenceMixin, TypingThrottle
 
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+def chat_group_id(chat_id):
+    return 'chat_%s' % chat_id
+
+
+def parse_frame(text_data):
+    """
+    Decoded client frame, None when it is not a JSON object
+    """
+
+    try:
+        frame = json.loads(text_data)
+    except (TypeError, ValueError):
+        return None
+    return frame if isinstance(frame, dict) else None
+
+
+class MessageMixin:
+    buffer = None
+    not_saved_message = 'The message could not be saved.'
+
+    async def send_message(self, chat_id, text_data_json):
+        """
+        Persist a message once and broadcast it to a room group
+        The sender comes from the authenticated connection, not from the frame
+        UTC time is included so the client can display it in each user's local time
+        In 'ack' durability mode the message is broadcast after it is committed,
+        in 'fire_and_forget' mode it is broadcast right away and written in the background
+        A frame retried with the same client_id is not written again, whether the first
+        one is committed or still buffered, the message is only sent back to the retrying socket
+        Invalid frames and messages that could not be saved are reported to the sender only
+        """
+
+        client_id = text_data_json.get('client_id')
+        serializer = MessageCreateSerializer(data=text_data_json)
+        if not serializer.is_valid():
+            await self.send_error(chat_id, serializer.errors, client_id)
+            return
+
+        idempotency_key = None
+        if client_id is not None:
+            idempotency_key = key_digest('ws', client_id)
+            if self.buffer.pending(self.user.pk, idempotency_key) is None:
+                record = await database_sync_to_async(replayed)(self.user.pk, idempotency_key)
+                if record is not None:
+                    await self.replay(chat_id, record.response)
+                    return
+            # the first frame may have been buffered while the database was asked
+            pending = self.buffer.pending(self.user.pk, idempotency_key)
+            if pending is not None:
+                message, persisted = pending
+                if not self.is_ack or await self.wait_committed(chat_id, client_id, persisted):
+                    await self.replay(chat_id, MessageListSerializer(message).data)
+                return
+
+        message = Message(chat_id=chat_id, sender=self.user, **serializer.validated_data)
+        message.idempotency_key = idempotency_key
+
+        persisted = self.buffer.add(message)
+        if self.is_ack:
+            if not await self.wait_committed(chat_id, client_id, persisted):
+                return
+        else:
+            message.created_at = timezone.now()
+            persisted.add_done_callback(lambda future: self.report_unsaved(future, chat_id, client_id))
+
+        await self.channel_layer.group_send(
+            chat_group_id(chat_id),
+            {
+                'type': 'chat_message',
+                'chat_id': chat_id,
+                'sender_id': self.user.pk,
+                'payload': json.dumps(MessageListSerializer(message).data),
+            }
+        )
+
+    @property
+    def is_ack(self) -> bool:
+        return settings.CHAT_MESSAGE_BUFFER['DURABILITY'] == Durability.ACK.value
+
+    async def wait_committed(self, chat_id, client_id, persisted) -> bool:
+        """
+        Wait for a buffered message, False when it was not written because it failed
+        or because its client_id was committed first, the sender is told either way
+        """
+
+        try:
+            await persisted
+        except DuplicateMessage as exc:
+            await self.replay(chat_id, exc.response)
+            return False
+        except Exception:
+            await self.send_error(chat_id, self.not_saved_message, client_id)
+            return False
+        return True
+
+    async def replay(self, chat_id, data):
+        await self.chat_message({
+            'chat_id': chat_id,
+            'sender_id': self.user.pk,
+            'payload': json.dumps(data),
+        })
+
+    def report_unsaved(self, future, chat_id, client_id):
+        """
+        A message broadcast before it was written tells its sender when the write failed
+        """
+
+        if not future.cancelled() and future.exception() is not None \
+                and not isinstance(future.exception(), DuplicateMessage):
+            asyncio.ensure_future(self.send_error(chat_id, self.not_saved_message, client_id))
+
+    async def send_error(self, chat_id, detail, client_id=None):
+        await self.send(text_data=json.dumps({'type': 'error', 'client_id': client_id, 'detail': detail}))
+
+
+class ChatConsumer(MessageMixin, PresenceMixin, AsyncWebsocketConsumer):
+    async def connect(self):
         """
         Connect to a chat room
-        Spaces are replaced like this: 'My new room' -> 'My_new_room'
+        Only the producer and the consumer of the chat are let in
         """
 
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.chat_group_id = 'chat_%s' % self.chat_id
+        self.chat_id = int(self.scope['url_route']['kwargs']['chat_id'])
+        self.chat_group_id = chat_group_id(self.chat_id)
+        self.user = self.scope['user']
+        if not self.user.is_authenticated or not await is_chat_member(self.user.pk, self.chat_id):
+            await self.close()
+            return
+        self.buffer = MessageBuffer.for_current_loop()
 
         # Join room group
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.chat_group_id,
             self.channel_name
         )
 
-        self.accept()
+        await self.accept()
+        await self.start_presence(self.user.pk)
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        if self.buffer is None:
+            return
+        await self.stop_presence()
+        await self.channel_layer.group_discard(
             self.chat_group_id,
             self.channel_name
         )
+        await self.buffer.flush()
 
-    def receive(self, text_data):
+    async def receive(self, text_data):
         """
-        Receive a message and broadcast it to a room group
-        UTC time is included so the client can display it in each user's local time
+        Dispatch a client frame by its type, frames without one are chat messages
         """
 
-        text_data_json = json.loads(text_data)
-        text = text_data_json['text']
-        chat_id = text_data_json['chat_id']
-        sender_id = text_data_json['sender_id']
-        message_type = text_data_json['message_type']
-
-        async_to_sync(self.channel_layer.group_send)(
-            self.chat_group_id,
-            {
-                'type': 'chat_message',
-                'text': text,
-                'chat_id': chat_id,
-                'sender_id': sender_id,
-                'message_type': message_type,
-            }
-        )
+        text_data_json = parse_frame(text_data)
+        if text_data_json is None:
+            await self.send_error(self.chat_id, 'Frames must be JSON objects.')
+            return
+        frame_type = text_data_json.get('type', 'message')
+        if frame_type == 'typing':
+            await self.typing(text_data_json.get('typing') is not False)
+        elif frame_type == 'message':
+            await self.send_message(self.chat_id, text_data_json)
 
-    def chat_message(self, event):
+    async def chat_message(self, event):
         """
         Receive a broadcast message and send it over a websocket
         """
 
-        text = event['text']
+        await self.send(text_data=event['payload'])
+
+
+class InboxConsumer(MessageMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user multiplexing all of their chats
+    Client frames carry a chat_id: 'subscribe', 'unsubscribe', 'message', 'typing' and 'read'
+    Outgoing frames go through a bounded queue, a client that falls too far behind
+    is disconnected and catches up through the messages endpoint with ?after=
+    """
+
+    slow_consumer_close_code = 4008
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        self.buffer = MessageBuffer.for_current_loop()
+        self.subscriptions = set()
+        self.unread = {}
+        self.typing_throttles = {}
+        self.outbound = asyncio.Queue(maxsize=settings.CHAT_INBOX['OUTBOUND_QUEUE_SIZE'])
+        self.writer = asyncio.ensure_future(self.write_outbound())
+
+        await self.accept()
+        self.unread = await user_unread_counts(self.user.pk)
+        await asyncio.gather(*(self.subscribe(chat_id) for chat_id in self.unread))
+
+    async def disconnect(self, close_code):
+        if self.buffer is None:
+            return
+        self.writer.cancel()
+        for throttle in self.typing_throttles.values():
+            throttle.cancel()
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(chat_group_id(chat_id), self.channel_name)
+            for chat_id in self.subscriptions
+        ))
+        await self.buffer.flush()
+
+    async def receive(self, text_data):
+        text_data_json = parse_frame(text_data)
+        try:
+            chat_id = int(text_data_json['chat_id'])
+        except (TypeError, KeyError, ValueError):
+            self.enqueue({'type': 'error', 'detail': 'Frames must be JSON objects with a chat_id.'})
+            return
+        frame_type = text_data_json.get('type', 'message')
+        if frame_type == 'subscribe':
+            if await is_chat_member(self.user.pk, chat_id):
+                await self.subscribe(chat_id)
+            else:
+                self.enqueue({'type': 'error', 'chat_id': chat_id, 'detail': 'Not a member of this chat.'})
+        elif frame_type == 'unsubscribe':
+            await self.unsubscribe(chat_id)
+        elif chat_id not in self.subscriptions:
+            self.enqueue({'type': 'error', 'chat_id': chat_id, 'detail': 'Not subscribed.'})
+        elif frame_type == 'message':
+            await self.send_message(chat_id, text_data_json)
+        elif frame_type == 'typing':
+            await self.typing(chat_id, text_data_json.get('typing') is not False)
+        elif frame_type == 'read':
+            self.unread[chat_id] = 0
+            await database_sync_to_async(Chat.objects.mark_read)(chat_id, self.user.pk)
+
+    async def subscribe(self, chat_id):
+        if chat_id in self.subscriptions:
+            return
+        self.subscriptions.add(chat_id)
+        self.unread.setdefault(chat_id, 0)
+        await self.channel_layer.group_add(chat_group_id(chat_id), self.channel_name)
+
+    async def unsubscribe(self, chat_id):
+        if chat_id not in self.subscriptions:
+            return
+        self.subscriptions.discard(chat_id)
+        self.unread.pop(chat_id, None)
+        throttle = self.typing_throttles.pop(chat_id, None)
+        if throttle is not None:
+            throttle.cancel()
+        await self.channel_layer.group_discard(chat_group_id(chat_id), self.channel_name)
+
+    async def typing(self, chat_id, typing=True):
+        throttle = self.typing_throttles.get(chat_id)
+        if throttle is None:
+            async def send(state):
+                await self.channel_layer.group_send(chat_group_id(chat_id), {
+                    'type': 'chat.typing',
+                    'chat_id': chat_id,
+                    'channel': self.channel_name,
+                    'user_id': self.user.pk,
+                    'typing': state,
+                })
+
+            throttle = self.typing_throttles[chat_id] = TypingThrottle(settings.CHAT_PRESENCE['TYPING_INTERVAL'], send)
+        await throttle.update(typing)
+
+    async def chat_message(self, event):
         chat_id = event['chat_id']
-        sender_id = event['sender_id']
-        message_type = event['message_type']
-        message = Message.objects.create(
-            text=text,
-            chat_id=chat_id,
-            sender_id=sender_id,
-            message_type=message_type
-        )
-        serializer = MessageListSerializer(message)
-        # Send message to WebSocket
-        self.send(text_data=json.dumps(serializer.data))
+        if chat_id not in self.subscriptions:
+            return
+        if event['sender_id'] != self.user.pk:
+            self.unread[chat_id] += 1
+        # the payload is already serialized, it is embedded without decoding it again
+        self.enqueue('{"type": "message", "chat_id": %d, "unread": %d, "message": %s}' % (
+            chat_id, self.unread[chat_id], event['payload']))
+
+    async def chat_typing(self, event):
+        if event['channel'] != self.channel_name and event['chat_id'] in self.subscriptions:
+            # a stop is the last frame of its kind, dropping it would leave the indicator on
+            self.enqueue({
+                'type': 'typing', 'chat_id': event['chat_id'], 'user_id': event['user_id'], 'typing': event['typing'],
+            }, droppable=event['typing'])
+
+    async def presence_changed(self, event):
+        pass
+
+    async def send_error(self, chat_id, detail, client_id=None):
+        self.enqueue({'type': 'error', 'chat_id': chat_id, 'client_id': client_id, 'detail': detail})
+
+    def enqueue(self, frame, droppable=False):
+        """
+        Queue a frame for the writer, transient frames are dropped when the queue is full
+        """
+
+        if not isinstance(frame, str):
+            frame = json.dumps(frame)
+        try:
+            self.outbound.put_nowait(frame)
+        except asyncio.QueueFull:
+            if not droppable:
+                self.writer.cancel()
+                asyncio.ensure_future(self.close(code=self.slow_consumer_close_code))
+
+    async def write_outbound(self):
+        while True:
+            await self.send(text_data=await self.outbound.get())
+
+
+@database_sync_to_async
+def user_unread_counts(user_id):
+    return dict(Chat.objects.for_member(user_id).with_viewer_state(user_id).values_list('id', 'unread'))
@@ -0,0 +1,116 @@
+import asyncio
+import bisect
+import hashlib
+import time
+import uuid
+from typing import Iterable
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """
+    Channel layer living in the process, for a single node and for tests
+    Unlike channels' InMemoryChannelLayer it never scans every channel and group,
+    expired messages and group memberships are dropped when they are touched
+    Group events are shallow-copied per member, consumers must not mutate nested values
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        self.channels = {}
+        self.groups = {}
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.local!%s' % (prefix.rstrip('.'), uuid.uuid4().hex)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.put(channel, dict(message), time.monotonic())
+
+    def put(self, channel, message, now):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue()
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((now + self.expiry, message))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue()
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.monotonic():
+                    return message
+        except asyncio.CancelledError:
+            # the consumer is shutting down, forget its inbox unless something is still queued
+            if queue.empty() and self.channels.get(channel) is queue:
+                del self.channels[channel]
+            raise
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.groups.setdefault(group, {})[channel] = time.monotonic() + self.group_expiry
+
+    async def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self.groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        members = self.groups.get(group)
+        if not members:
+            return
+        now = time.monotonic()
+        for channel, expires in list(members.items()):
+            if expires < now:
+                del members[channel]
+                continue
+            try:
+                self.put(channel, dict(message), now)
+            except ChannelFull:
+                pass
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+
+    async def close(self):
+        pass
+
+
+class HashRing:
+    """
+    Consistent hash ring, adding or removing a node only moves the keys of its neighbours
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 64):
+        self.ring = sorted(
+            (self.hash('%s-%s' % (node, replica)), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self.keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'big')
+
+    def get(self, value: str) -> int:
+        position = bisect.bisect(self.keys, self.hash(value)) % len(self.keys)
+        return self.ring[position][1]
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from app.models import Category, Chat, Message, Order
+from chat_consumer.middleware import JWTAuthMiddlewareStack
+from chat_consumer.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = 'Measures chat fan-out throughput and latency for growing group sizes, in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2,8,32', help='Comma-separated numbers of sockets in the chat')
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--layer', choices=('memory', 'current'), default='memory',
+                            help="'memory' uses LocalChannelLayer, 'current' the configured CHANNEL_LAYERS")
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        layers = settings.CHANNEL_LAYERS
+        if options['layer'] == 'memory':
+            layers = {'default': {'BACKEND': 'chat_consumer.layers.LocalChannelLayer', 'CONFIG': {'capacity': 10000}}}
+
+        # consumers write through their own connections in worker threads, a transaction of
+        # this command could not roll their rows back, so everything lives in a test database
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        databases = runner.setup_databases()
+        try:
+            producer = User.objects.create(username='bench_chat_producer')
+            consumer = User.objects.create(username='bench_chat_consumer')
+            category = Category.objects.create(name='Benchmark')
+            order = Order.objects.create(title='Benchmark', description='Benchmark', author=producer, price=0,
+                                         category=category)
+            chat = Chat.objects.create(order=order, producer=producer, consumer=consumer)
+            with override_settings(CHANNEL_LAYERS=layers):
+                channel_layers.backends = {}
+                self.stdout.write('sockets  messages/s  deliveries/s  p50 ms  p99 ms')
+                for size in map(int, options['sizes'].split(',')):
+                    result = async_to_sync(self.run)(chat, (producer, consumer), size, options)
+                    self.stdout.write('%7d  %10.1f  %12.1f  %6.2f  %6.2f' % result)
+        finally:
+            channel_layers.backends = {}
+            runner.teardown_databases(databases)
+
+    async def run(self, chat, users, size, options):
+        application = JWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        communicators = [
+            WebsocketCommunicator(application, '/ws/%s/?token=%s' % (chat.pk, tokens[index % 2]))
+            for index in range(size)
+        ]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            assert connected, 'Socket was rejected'
+
+        latencies = []
+        started = time.perf_counter()
+        receivers = [
+            asyncio.ensure_future(self.collect(communicator, options['messages'], latencies, options['timeout']))
+            for communicator in communicators
+        ]
+        sender = communicators[0]
+        for _ in range(options['messages']):
+            await sender.send_json_to({'text': repr(time.perf_counter()), 'message_type': Message.MessageTypes.TEXT.value})
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        latencies.sort()
+        return (
+            size,
+            options['messages'] / elapsed,
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        )
+
+    @staticmethod
+    async def collect(communicator, count, latencies, timeout):
+        received = 0
+        while received < count:
+            frame = json.loads(await communicator.receive_from(timeout=timeout))
+            # presence and typing frames carry a type, chat messages do not
+            if 'type' in frame:
+                continue
+            latencies.append(time.perf_counter() - float(frame['text']))
+            received += 1
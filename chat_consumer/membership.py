@@ -0,0 +1,31 @@
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+
+from app.models import Chat
+from core.cache import get_cache
+
+
+def membership_key(user_id, chat_id):
+    return 'chat_member:%s:%s' % (chat_id, user_id)
+
+
+@database_sync_to_async
+def is_chat_member(user_id, chat_id) -> bool:
+    """
+    Whether the user is the producer or the consumer of the chat
+    Results are shared through the cache for a short time, so reconnect storms
+    do not run one query per socket
+    """
+
+    cache = get_cache()
+    key = membership_key(user_id, chat_id)
+    member = cache.get(key)
+    if member is None:
+        member = Chat.objects.filter(Q(producer_id=user_id) | Q(consumer_id=user_id), pk=chat_id).exists()
+        cache.set(key, member, settings.CHAT_MEMBERSHIP_CACHE_TIMEOUT)
+    return member
+
+
+def forget_membership(chat):
+    get_cache().delete_many([membership_key(user_id, chat.pk) for user_id in (chat.producer_id, chat.consumer_id)])
@@ -0,0 +1,33 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope['user'] from the same JWT access tokens the REST API accepts
+    Browsers can not set headers on a websocket, so the token is read from ?token=
+    """
+
+    authentication = JWTAuthentication()
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        scope['user'] = await self.get_user(token[0]) if token else AnonymousUser()
+        return await super().__call__(scope, receive, send)
+
+    @database_sync_to_async
+    def get_user(self, raw_token):
+        try:
+            return self.authentication.get_user(self.authentication.get_validated_token(raw_token))
+        except (InvalidToken, AuthenticationFailed):
+            return AnonymousUser()
+
+
+def JWTAuthMiddlewareStack(inner):
+    return JWTAuthMiddleware(inner)
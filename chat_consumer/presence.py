@@ -0,0 +1,175 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from core.cache import get_cache
+
+
+class PresenceStore:
+    """
+    Connections online in a chat, kept in the cache under one key per chat so every
+    process sees the same roster, {channel name: (user id, expiry timestamp)}
+    A user stays online while any of their sockets is alive, entries of sockets that
+    died without leaving expire ttl seconds after their last refresh
+    Concurrent writes may drop an entry, it is back with the connection's next refresh
+    """
+
+    def __init__(self, chat_id, ttl: float):
+        self.key = 'presence:%s' % chat_id
+        self.ttl = ttl
+
+    def refresh(self, channel_name, user_id):
+        return self.update(channel_name, user_id)
+
+    def remove(self, channel_name):
+        return self.update(channel_name, None)
+
+    def update(self, channel_name, user_id):
+        """
+        Refresh the entry of a connection (or remove it when user_id is None) and drop expired ones
+        Returns the online user ids, None when they did not change
+        """
+
+        cache = get_cache()
+        now = time.time()
+        entries = cache.get(self.key) or {}
+        before = members(entries)
+        entries = {channel: entry for channel, entry in entries.items() if entry[1] > now}
+        if user_id is None:
+            entries.pop(channel_name, None)
+        else:
+            entries[channel_name] = (user_id, now + self.ttl)
+        if entries:
+            cache.set(self.key, entries, self.ttl)
+        else:
+            cache.delete(self.key)
+        after = members(entries)
+        return after if after != before else None
+
+    def online(self):
+        now = time.time()
+        return members({
+            channel: entry for channel, entry in (get_cache().get(self.key) or {}).items() if entry[1] > now
+        })
+
+
+def members(entries):
+    return sorted({user_id for user_id, _ in entries.values()})
+
+
+class TypingThrottle:
+    """
+    Leading and trailing throttle of a connection's typing state in one chat
+    The first frame goes out right away, frames within interval seconds of it are
+    folded into one trailing event with the latest state, so a stop is never lost
+    """
+
+    def __init__(self, interval: float, send):
+        self.interval = interval
+        self.send = send
+        self.state = None
+        self.sent_state = False
+        self.sent_at = float('-inf')
+        self.trailing = None
+
+    async def update(self, typing: bool):
+        self.state = typing
+        if self.trailing is not None:
+            return
+        wait = self.sent_at + self.interval - time.monotonic()
+        if wait > 0:
+            self.trailing = asyncio.ensure_future(self.send_later(wait))
+        else:
+            await self.flush()
+
+    async def send_later(self, wait):
+        await asyncio.sleep(wait)
+        self.trailing = None
+        await self.flush()
+
+    async def flush(self):
+        # typing is repeated every interval while it lasts, a stop only once
+        if not self.state and not self.sent_state:
+            return
+        self.sent_state, self.sent_at = self.state, time.monotonic()
+        await self.send(self.state)
+
+    def cancel(self):
+        if self.trailing is not None:
+            self.trailing.cancel()
+            self.trailing = None
+
+
+class PresenceMixin:
+    """
+    Online roster and typing indicators of a chat
+    The roster lives in the cache, each connection refreshes its own entry every heartbeat
+    and the group only hears about it when the online users change: a join, a leave,
+    or an entry that expired
+    Typing frames are throttled per connection before they fan out to the group
+    """
+
+    presence_user_id = None
+
+    async def start_presence(self, user_id):
+        config = settings.CHAT_PRESENCE
+        self.presence_user_id = user_id
+        self.presence = PresenceStore(self.chat_id, config['TTL'])
+        self.typing_throttle = TypingThrottle(config['TYPING_INTERVAL'], self.send_typing)
+        online = await sync_to_async(self.presence.refresh)(self.channel_name, user_id)
+        if online is None:
+            await self.send_roster(await sync_to_async(self.presence.online)())
+        else:
+            await self.broadcast_presence(online)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat(config['HEARTBEAT_INTERVAL']))
+
+    async def stop_presence(self):
+        if self.presence_user_id is None:
+            return
+        self.heartbeat_task.cancel()
+        self.typing_throttle.cancel()
+        online = await sync_to_async(self.presence.remove)(self.channel_name)
+        if online is not None:
+            await self.broadcast_presence(online)
+
+    async def heartbeat(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            online = await sync_to_async(self.presence.refresh)(self.channel_name, self.presence_user_id)
+            if online is not None:
+                await self.broadcast_presence(online)
+
+    async def broadcast_presence(self, online):
+        await self.channel_layer.group_send(self.chat_group_id, {
+            'type': 'presence.changed',
+            'chat_id': self.chat_id,
+            'online': online,
+        })
+
+    async def presence_changed(self, event):
+        if self.presence_user_id is not None:
+            await self.send_roster(event['online'])
+
+    async def send_roster(self, online):
+        await self.send(text_data=json.dumps({'type': 'presence', 'online': online}))
+
+    async def typing(self, typing=True):
+        if self.presence_user_id is not None:
+            await self.typing_throttle.update(typing)
+
+    async def send_typing(self, typing):
+        await self.channel_layer.group_send(self.chat_group_id, {
+            'type': 'chat.typing',
+            'chat_id': self.chat_id,
+            'channel': self.channel_name,
+            'user_id': self.presence_user_id,
+            'typing': typing,
+        })
+
+    async def chat_typing(self, event):
+        if event['channel'] != self.channel_name:
+            await self.send(text_data=json.dumps({
+                'type': 'typing', 'user_id': event['user_id'], 'typing': event['typing']}))
@@ -0,0 +1,19 @@
+from channels_redis.core import RedisChannelLayer
+
+from chat_consumer.layers import HashRing
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer spreading groups and channels over several hosts with a hash ring,
+    so a chat_<id> group stays on its host when hosts are added or removed
+    """
+
+    def __init__(self, hosts=None, replicas=64, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.hash_ring = HashRing([repr(host) for host in self.hosts], replicas)
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        return self.hash_ring.get(value)
@@ -2,5 +2,6 @@ from django.urls import re_path
 from chat_consumer import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/(?P<chat_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/$', consumers.InboxConsumer.as_asgi()),
+    re_path(r'ws/(?P<chat_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
 ]
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from app.models import Chat
+from chat_consumer.membership import forget_membership
+
+
+@receiver(post_save, sender=Chat)
+@receiver(post_delete, sender=Chat)
+def invalidate_membership(sender, instance, **kwargs):
+    forget_membership(instance)
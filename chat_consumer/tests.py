@@ -0,0 +1,519 @@
+import asyncio
+import time
+from unittest import mock
+
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from app.idempotency import key_digest
+from app.models import Category, Chat, IdempotencyKey, Message, Order
+from chat_consumer.buffer import DuplicateMessage, MessageBuffer
+from chat_consumer.consumers import InboxConsumer, chat_group_id
+from chat_consumer.layers import HashRing, LocalChannelLayer
+from chat_consumer.middleware import JWTAuthMiddlewareStack
+from chat_consumer.presence import PresenceStore, TypingThrottle
+from chat_consumer.redis_layer import ShardedRedisChannelLayer
+from chat_consumer.routing import websocket_urlpatterns
+from core.cache import get_cache
+
+TEXT = Message.MessageTypes.TEXT.value
+
+# the tests run in one process, they do not need the shared redis cache
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class LocalChannelLayerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = LocalChannelLayer(capacity=2)
+
+    async def receive(self, channel):
+        return await asyncio.wait_for(self.layer.receive(channel), 1)
+
+    async def test_group_send_reaches_every_member(self):
+        channels = [await self.layer.new_channel() for _ in range(3)]
+        for channel in channels:
+            await self.layer.group_add('chat_1', channel)
+        await self.layer.group_discard('chat_1', channels[2])
+        await self.layer.group_send('chat_1', {'type': 'chat.message', 'text': 'Hello'})
+
+        for channel in channels[:2]:
+            self.assertEqual(await self.receive(channel), {'type': 'chat.message', 'text': 'Hello'})
+        self.assertNotIn(channels[2], self.layer.channels)
+
+    async def test_members_get_their_own_copy(self):
+        first, second = await self.layer.new_channel(), await self.layer.new_channel()
+        await self.layer.group_add('chat_1', first)
+        await self.layer.group_add('chat_1', second)
+        await self.layer.group_send('chat_1', {'type': 'chat.message'})
+
+        (await self.receive(first))['type'] = 'changed'
+        self.assertEqual(await self.receive(second), {'type': 'chat.message'})
+
+    async def test_expired_messages_are_skipped(self):
+        channel = await self.layer.new_channel()
+        with mock.patch('chat_consumer.layers.time.monotonic', return_value=-self.layer.expiry - 1):
+            await self.layer.send(channel, {'type': 'old'})
+        await self.layer.send(channel, {'type': 'new'})
+        self.assertEqual(await self.receive(channel), {'type': 'new'})
+
+    async def test_expired_memberships_are_dropped(self):
+        channel = await self.layer.new_channel()
+        with mock.patch('chat_consumer.layers.time.monotonic', return_value=-self.layer.group_expiry - 1):
+            await self.layer.group_add('chat_1', channel)
+        await self.layer.group_send('chat_1', {'type': 'chat.message'})
+        self.assertEqual(self.layer.groups['chat_1'], {})
+        self.assertNotIn(channel, self.layer.channels)
+
+    async def test_capacity(self):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add('chat_1', channel)
+        await self.layer.send(channel, {'type': 'first'})
+        await self.layer.send(channel, {'type': 'second'})
+        with self.assertRaises(ChannelFull):
+            await self.layer.send(channel, {'type': 'third'})
+        # a full member does not fail the group send of the others
+        await self.layer.group_send('chat_1', {'type': 'dropped'})
+        self.assertEqual(await self.receive(channel), {'type': 'first'})
+        self.assertEqual(await self.receive(channel), {'type': 'second'})
+
+
+class HashRingTests(SimpleTestCase):
+    keys = ['chat_%s' % index for index in range(2000)]
+
+    def test_stable(self):
+        ring = HashRing(['a', 'b', 'c'])
+        again = HashRing(['a', 'b', 'c'])
+        self.assertEqual([ring.get(key) for key in self.keys], [again.get(key) for key in self.keys])
+        self.assertEqual({ring.get(key) for key in self.keys}, {0, 1, 2})
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in self.keys if before.get(key) != after.get(key)]
+        self.assertTrue(all(after.get(key) == 3 for key in moved))
+        # roughly a quarter of the keys belongs to the new node
+        self.assertLess(len(moved), len(self.keys) / 2)
+
+    def test_sharded_redis_layer_uses_the_ring(self):
+        hosts = ['redis://a:6379', 'redis://b:6379', 'redis://c:6379']
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+        ring = HashRing([repr(host) for host in layer.hosts])
+        for key in self.keys[:100]:
+            self.assertEqual(layer.consistent_hash(key), ring.get(key))
+            self.assertEqual(layer.consistent_hash(key.encode()), ring.get(key))
+
+
+@override_settings(
+    CACHES=LOCAL_CACHES,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'chat_consumer.layers.LocalChannelLayer'}},
+)
+class ChatSocketTestCase(TransactionTestCase):
+    """
+    Sockets of a chat between a producer and a consumer, the buffer writes from
+    worker threads so rows have to be committed
+    """
+
+    def setUp(self):
+        get_cache().clear()
+        channel_layers.backends = {}
+        self.producer = User.objects.create(username='producer')
+        self.consumer = User.objects.create(username='consumer')
+        order = Order.objects.create(title='Order', description='Description', author=self.producer, price=1,
+                                     category=Category.objects.create(name='Category'))
+        self.chat = Chat.objects.create(order=order, producer=self.producer, consumer=self.consumer)
+
+    def tearDown(self):
+        channel_layers.backends = {}
+
+    async def connect(self, user, path=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path or 'ws/%s/' % self.chat.pk)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @staticmethod
+    async def receive_error(communicator):
+        # presence frames may arrive in between
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame.get('type') == 'error':
+                return frame
+
+    @staticmethod
+    async def receive_message(communicator, timeout=2):
+        while True:
+            frame = await communicator.receive_json_from(timeout=timeout)
+            if 'text' in frame:
+                return frame
+
+
+class MessageValidationTests(ChatSocketTestCase):
+
+    async def test_invalid_frames_are_rejected_to_their_sender(self):
+        producer = await self.connect(self.producer)
+        consumer = await self.connect(self.consumer)
+        for frame in (
+            {'text': 'Hello', 'message_type': -5},
+            {'message_type': TEXT},
+            {'text': 'Hello'},
+        ):
+            await producer.send_json_to(dict(frame, client_id='bad'))
+            error = await self.receive_error(producer)
+            self.assertEqual(error['client_id'], 'bad')
+        await producer.send_to(text_data='not json')
+        self.assertEqual((await self.receive_error(producer))['detail'], 'Frames must be JSON objects.')
+
+        await producer.send_json_to({'text': 'Hello', 'message_type': TEXT})
+        self.assertEqual((await self.receive_message(consumer))['text'], 'Hello')
+        self.assertEqual((await self.receive_message(producer))['text'], 'Hello')
+        await producer.disconnect()
+        await consumer.disconnect()
+        self.assertEqual(await saved_texts(), ['Hello'])
+
+    async def test_unsaved_fire_and_forget_message_is_reported_to_its_sender(self):
+        producer = await self.connect(self.producer)
+        buffer_settings = dict(settings.CHAT_MESSAGE_BUFFER, DURABILITY='fire_and_forget')
+        with override_settings(CHAT_MESSAGE_BUFFER=buffer_settings), \
+                mock.patch.object(MessageBuffer, 'insert', side_effect=DatabaseError('down')), \
+                self.assertLogs('chat_consumer.buffer', 'ERROR'):
+            await producer.send_json_to({'text': 'Hello', 'message_type': TEXT, 'client_id': 'lost'})
+            self.assertEqual((await self.receive_message(producer))['text'], 'Hello')
+            error = await self.receive_error(producer)
+        self.assertEqual(error, {'type': 'error', 'client_id': 'lost', 'detail': 'The message could not be saved.'})
+        await producer.disconnect()
+
+
+class MessageBufferTests(ChatSocketTestCase):
+
+    async def test_rejected_message_fails_alone(self):
+        buffer = MessageBuffer(max_size=10, flush_interval=10)
+        good = buffer.add(Message(chat_id=self.chat.pk, sender=self.producer, text='Good', message_type=TEXT))
+        bad = buffer.add(Message(chat_id=self.chat.pk, sender=self.consumer, text='Bad', message_type=-5))
+        also_good = buffer.add(Message(chat_id=self.chat.pk, sender=self.consumer, text='Also', message_type=TEXT))
+        with self.assertLogs('chat_consumer.buffer', 'ERROR'):
+            await buffer.flush()
+            with self.assertRaises(IntegrityError):
+                await bad
+            # failures are logged from a done callback
+            await asyncio.sleep(0)
+
+        await good
+        await also_good
+        self.assertEqual(await saved_texts(), ['Good', 'Also'])
+
+
+class IdempotentMessageTests(ChatSocketTestCase):
+
+    def keyed(self, text, client_id='retried', message_type=TEXT):
+        message = Message(chat_id=self.chat.pk, sender=self.producer, text=text, message_type=message_type)
+        message.idempotency_key = key_digest('ws', client_id)
+        return message
+
+    async def test_retry_of_a_buffered_message(self):
+        producer = await self.connect(self.producer)
+        consumer = await self.connect(self.consumer)
+        buffer_settings = dict(settings.CHAT_MESSAGE_BUFFER, FLUSH_INTERVAL=0.2)
+        with override_settings(CHAT_MESSAGE_BUFFER=buffer_settings):
+            for _ in range(2):
+                await producer.send_json_to({'text': 'Hello', 'message_type': TEXT, 'client_id': 'retried'})
+            # the broadcast and the replay to the retrying socket
+            self.assertEqual((await self.receive_message(producer))['text'], 'Hello')
+            self.assertEqual((await self.receive_message(producer))['text'], 'Hello')
+            self.assertEqual((await self.receive_message(consumer))['text'], 'Hello')
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.receive_message(consumer, 0.3)
+        await producer.disconnect()
+        await consumer.disconnect()
+        self.assertEqual(await saved_texts(), ['Hello'])
+
+    async def test_same_key_in_one_batch(self):
+        buffer = MessageBuffer(max_size=10, flush_interval=10)
+        first = buffer.add(self.keyed('First'))
+        self.assertIs(buffer.add(self.keyed('Retry')), first)
+        await buffer.flush()
+        self.assertEqual((await first).text, 'First')
+        self.assertIsNone(buffer.pending(self.producer.pk, key_digest('ws', 'retried')))
+        self.assertEqual(await saved_texts(), ['First'])
+
+    async def test_key_committed_by_another_batch(self):
+        await database_sync_to_async(MessageBuffer.insert)([self.keyed('First')])
+        failures = await database_sync_to_async(MessageBuffer.write)([
+            self.keyed('Retry'), self.keyed('Other', 'other')])
+        self.assertEqual(list(failures), [0])
+        self.assertIsInstance(failures[0], DuplicateMessage)
+        self.assertEqual(failures[0].response['text'], 'First')
+        self.assertEqual(await saved_texts(), ['First', 'Other'])
+
+    async def test_expired_key_is_reused(self):
+        await database_sync_to_async(IdempotencyKey.objects.create)(
+            user=self.producer, key=key_digest('ws', 'retried'), status_code=200, response={},
+            expires_at=timezone.now())
+        self.assertEqual(await database_sync_to_async(MessageBuffer.write)([self.keyed('Again')]), {})
+        self.assertEqual(await saved_texts(), ['Again'])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class PresenceStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.store = PresenceStore(1, ttl=45)
+
+    def test_changes(self):
+        self.assertEqual(self.store.refresh('first', 1), [1])
+        self.assertIsNone(self.store.refresh('second', 1))
+        self.assertEqual(self.store.refresh('third', 2), [1, 2])
+        # heartbeats only refresh
+        self.assertIsNone(self.store.refresh('first', 1))
+        self.assertIsNone(self.store.remove('first'))
+        self.assertEqual(self.store.remove('second'), [2])
+        self.assertEqual(self.store.online(), [2])
+        self.assertEqual(self.store.remove('third'), [])
+
+    def test_expiry(self):
+        self.store.refresh('first', 1)
+        # a socket that died without leaving, its last refresh was longer than the ttl ago
+        entries = get_cache().get(self.store.key)
+        entries['silent'] = (2, time.time() - 1)
+        get_cache().set(self.store.key, entries)
+        self.assertEqual(self.store.online(), [1])
+        # the roster the others saw still had the silent user
+        self.assertEqual(self.store.refresh('first', 1), [1])
+        self.assertIsNone(self.store.refresh('first', 1))
+
+
+class TypingThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.throttle = TypingThrottle(0.05, self.send)
+
+    async def send(self, typing):
+        self.sent.append(typing)
+
+    async def test_stop_after_a_throttled_frame_is_sent(self):
+        await self.throttle.update(True)
+        await self.throttle.update(True)
+        await self.throttle.update(False)
+        self.assertEqual(self.sent, [True])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True, False])
+
+    async def test_typing_is_repeated_and_stops_once(self):
+        await self.throttle.update(True)
+        await asyncio.sleep(0.06)
+        await self.throttle.update(True)
+        await self.throttle.update(False)
+        await asyncio.sleep(0.1)
+        await self.throttle.update(False)
+        self.assertEqual(self.sent, [True, True, False])
+
+    async def test_cancel(self):
+        await self.throttle.update(True)
+        await self.throttle.update(False)
+        self.throttle.cancel()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True])
+
+
+class PresenceTests(ChatSocketTestCase):
+
+    @staticmethod
+    async def receive_presence(communicator):
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame.get('type') == 'presence':
+                return frame['online']
+
+    async def test_roster_is_broadcast_on_changes_only(self):
+        presence_settings = dict(settings.CHAT_PRESENCE, HEARTBEAT_INTERVAL=0.05)
+        with override_settings(CHAT_PRESENCE=presence_settings):
+            producer = await self.connect(self.producer)
+            self.assertEqual(await self.receive_presence(producer), [self.producer.pk])
+            consumer = await self.connect(self.consumer)
+            self.assertEqual(await self.receive_presence(consumer), [self.producer.pk, self.consumer.pk])
+            self.assertEqual(await self.receive_presence(producer), [self.producer.pk, self.consumer.pk])
+
+            # a second socket of the same user and a few heartbeats change nothing
+            again = await self.connect(self.consumer)
+            self.assertEqual(await self.receive_presence(again), [self.producer.pk, self.consumer.pk])
+            self.assertTrue(await producer.receive_nothing(0.3))
+
+            await again.disconnect()
+            await consumer.disconnect()
+            self.assertEqual(await self.receive_presence(producer), [self.producer.pk])
+            await producer.disconnect()
+
+    async def test_trailing_stop(self):
+        presence_settings = dict(settings.CHAT_PRESENCE, TYPING_INTERVAL=0.1)
+        with override_settings(CHAT_PRESENCE=presence_settings):
+            producer = await self.connect(self.producer)
+            consumer = await self.connect(self.consumer)
+            await producer.send_json_to({'type': 'typing'})
+            await producer.send_json_to({'type': 'typing', 'typing': False})
+            frames = []
+            while len(frames) < 2:
+                frame = await consumer.receive_json_from(timeout=2)
+                if frame.get('type') == 'typing':
+                    frames.append(frame)
+            self.assertEqual([frame['typing'] for frame in frames], [True, False])
+            await producer.disconnect()
+            await consumer.disconnect()
+
+
+class InboxConsumerTests(ChatSocketTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other_chat = Chat.objects.create(order=self.chat.order, producer=self.producer,
+                                              consumer=User.objects.create(username='other'))
+
+    async def connect_inbox(self, user):
+        inbox = await self.connect(user, 'ws/')
+        await self.settle(inbox)
+        return inbox
+
+    @staticmethod
+    async def settle(inbox):
+        # frames are handled in order, the answer to a bad one means every earlier frame was handled
+        await inbox.send_json_to({})
+        while (await inbox.receive_json_from(timeout=2))['type'] != 'error':
+            pass
+
+    @staticmethod
+    async def receive_inbox_message(inbox):
+        while True:
+            frame = await inbox.receive_json_from(timeout=2)
+            if frame['type'] == 'message':
+                return frame
+
+    @staticmethod
+    async def broadcast(chat_id, event_type='chat_message', **event):
+        event = dict(event, type=event_type, chat_id=chat_id)
+        await channel_layers['default'].group_send(chat_group_id(chat_id), event)
+
+    async def test_unread_counter(self):
+        await database_sync_to_async(Chat.objects.filter(pk=self.chat.pk).update)(consumer_unread=3)
+        inbox = await self.connect_inbox(self.consumer)
+        producer = await self.connect(self.producer)
+        for text in ('First', 'Second'):
+            await producer.send_json_to({'text': text, 'message_type': TEXT})
+        first, second = [await self.receive_inbox_message(inbox) for _ in range(2)]
+        self.assertEqual((first['chat_id'], first['unread'], first['message']['text']), (self.chat.pk, 4, 'First'))
+        self.assertEqual(second['unread'], 5)
+
+        await inbox.send_json_to({'type': 'read', 'chat_id': self.chat.pk})
+        await self.settle(inbox)
+        chat = await database_sync_to_async(Chat.objects.get)(pk=self.chat.pk)
+        self.assertEqual((chat.consumer_unread, chat.consumer_last_read_id), (0, chat.last_message_id))
+        # the user's own messages are not unread
+        await inbox.send_json_to({'chat_id': self.chat.pk, 'text': 'Own', 'message_type': TEXT})
+        await producer.send_json_to({'text': 'Third', 'message_type': TEXT})
+        own, third = [await self.receive_inbox_message(inbox) for _ in range(2)]
+        self.assertEqual((own['message']['text'], own['unread']), ('Own', 0))
+        self.assertEqual((third['message']['text'], third['unread']), ('Third', 1))
+        await producer.disconnect()
+        await inbox.disconnect()
+
+    async def test_subscribe_and_unsubscribe(self):
+        inbox = await self.connect_inbox(self.consumer)
+        await inbox.send_json_to({'type': 'unsubscribe', 'chat_id': self.chat.pk})
+        await self.settle(inbox)
+        await self.broadcast(self.chat.pk, sender_id=self.producer.pk, payload='{"text": "Missed"}')
+        self.assertTrue(await inbox.receive_nothing(0.1))
+        await inbox.send_json_to({'chat_id': self.chat.pk, 'text': 'Hello', 'message_type': TEXT})
+        self.assertEqual(await inbox.receive_json_from(timeout=2),
+                         {'type': 'error', 'chat_id': self.chat.pk, 'detail': 'Not subscribed.'})
+
+        await inbox.send_json_to({'type': 'subscribe', 'chat_id': self.chat.pk})
+        await self.settle(inbox)
+        await self.broadcast(self.chat.pk, sender_id=self.producer.pk, payload='{"text": "Delivered"}')
+        self.assertEqual((await self.receive_inbox_message(inbox))['message'], {'text': 'Delivered'})
+        await inbox.disconnect()
+
+    async def test_subscribing_to_a_chat_of_others(self):
+        inbox = await self.connect_inbox(self.consumer)
+        await inbox.send_json_to({'type': 'subscribe', 'chat_id': self.other_chat.pk})
+        self.assertEqual(await inbox.receive_json_from(timeout=2), {
+            'type': 'error', 'chat_id': self.other_chat.pk, 'detail': 'Not a member of this chat.'})
+        await self.broadcast(self.other_chat.pk, sender_id=self.producer.pk, payload='{"text": "Private"}')
+        self.assertTrue(await inbox.receive_nothing(0.1))
+        await inbox.disconnect()
+
+    async def test_slow_client_is_disconnected(self):
+        inbox_settings = dict(settings.CHAT_INBOX, OUTBOUND_QUEUE_SIZE=2)
+        with override_settings(CHAT_INBOX=inbox_settings):
+            inbox = await self.connect_inbox(self.consumer)
+        async def stall(consumer, text_data=None, bytes_data=None, close=False):
+            await asyncio.Event().wait()
+
+        with mock.patch.object(InboxConsumer, 'send', stall):
+            # the idle writer already looked up the real send, the first frame still goes out
+            for _ in range(6):
+                await self.broadcast(self.chat.pk, 'chat.typing', channel='other', user_id=self.producer.pk,
+                                     typing=True)
+            self.assertEqual((await inbox.receive_json_from(timeout=2))['type'], 'typing')
+            # the writer holds the second frame and the queue the next two, typing frames beyond it are dropped
+            self.assertTrue(await inbox.receive_nothing(0.1))
+            await self.broadcast(self.chat.pk, sender_id=self.producer.pk, payload='{"text": "Hello"}')
+            self.assertEqual(await inbox.receive_output(timeout=2), {'type': 'websocket.close', 'code': 4008})
+        await inbox.disconnect()
+
+
+class JWTAuthMiddlewareTests(ChatSocketTestCase):
+
+    async def open(self, path, token=None):
+        query = '' if token is None else '?token=%s' % token
+        communicator = WebsocketCommunicator(JWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns)), path + query)
+        connected, _ = await communicator.connect()
+        if connected:
+            await communicator.disconnect()
+        return connected
+
+    @staticmethod
+    def token(user, issued=None):
+        token = AccessToken.for_user(user)
+        if issued is not None:
+            token.set_exp(from_time=issued)
+        return str(token)
+
+    async def test_tokens(self):
+        self.assertTrue(await self.open('ws/', self.token(self.consumer)))
+        self.assertFalse(await self.open('ws/'))
+        self.assertFalse(await self.open('ws/', 'invalid'))
+        expired = self.token(self.consumer, timezone.now() - settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'] * 2)
+        self.assertFalse(await self.open('ws/', expired))
+
+    async def test_chat_members_only(self):
+        chat_path = 'ws/%s/' % self.chat.pk
+        self.assertTrue(await self.open(chat_path, self.token(self.producer)))
+        outsider = await database_sync_to_async(User.objects.create)(username='outsider')
+        self.assertFalse(await self.open(chat_path, self.token(outsider)))
+        self.assertFalse(await self.open(chat_path))
+
+    async def test_membership_is_cached(self):
+        chat_path = 'ws/%s/' % self.chat.pk
+        self.assertTrue(await self.open(chat_path, self.token(self.consumer)))
+        # an UPDATE sends no signal, the cached answer is used until it times out
+        outsider = await database_sync_to_async(User.objects.create)(username='outsider')
+        await database_sync_to_async(Chat.objects.filter(pk=self.chat.pk).update)(consumer=outsider)
+        self.assertTrue(await self.open(chat_path, self.token(self.consumer)))
+        self.assertTrue(await self.open(chat_path, self.token(outsider)))
+        await database_sync_to_async(get_cache().clear)()
+        self.assertFalse(await self.open(chat_path, self.token(self.consumer)))
+
+
+@database_sync_to_async
+def saved_texts():
+    return list(Message.objects.order_by('id').values_list('text', flat=True))
@@ -1,16 +1,18 @@
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-import chat_consumer.routing
-
 # os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
+django_asgi_application = get_asgi_application()
+
+import chat_consumer.routing  # noqa: E402
+from chat_consumer.middleware import JWTAuthMiddlewareStack  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_application,
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(
             chat_consumer.routing.websocket_urlpatterns
         )
@@ -135,6 +135,10 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': (
+        'core.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     )
@@ -153,15 +157,121 @@ DJANGO_SUPERUSER_EMAIL = os.environ.get('DJANGO_SUPERUSER_EMAIL', 'vovakolesniko
 
 CORS_ORIGIN_ALLOW_ALL = DEBUG
 
+# CHANNEL_LAYER selects 'redis' (first host), 'sharded' (all hosts on a hash ring)
+# or 'memory' (single process, tests and local benchmarks)
+CHANNEL_REDIS_HOSTS = [
+    (host, int(port)) for host, port in (
+        address.split(':') for address in os.getenv('CHANNEL_REDIS_HOSTS', '127.0.0.1:6379').split(',')
+    )
+]
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+        'redis': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                "hosts": CHANNEL_REDIS_HOSTS[:1],
+            },
+        },
+        'sharded': {
+            'BACKEND': 'chat_consumer.redis_layer.ShardedRedisChannelLayer',
+            'CONFIG': {
+                "hosts": CHANNEL_REDIS_HOSTS,
+            },
         },
+        'memory': {
+            'BACKEND': 'chat_consumer.layers.LocalChannelLayer',
+        },
+    }[os.getenv('CHANNEL_LAYER', 'redis')],
+}
+
+# CACHE selects 'redis' (shared by every worker) or 'memory' (single process, tests and local benchmarks),
+# response versions, the recompute lock, chat presence and membership checks only hold across workers with redis
+CACHES = {
+    'default': {
+        'redis': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.getenv('CACHE_LOCATION', 'redis://127.0.0.1:6379/1'),
+        },
+        'memory': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'artfury',
+        },
+    }[os.getenv('CACHE', 'redis')],
+}
+
+# Read-through cache of API responses, LOCK_TIMEOUT bounds how long concurrent requests
+# wait for the one request recomputing a missing entry
+RESOURCE_CACHE = {
+    'ALIAS': 'default',
+    'TIMEOUT': int(os.getenv('RESOURCE_CACHE_TIMEOUT', 300)),
+    'LOCK_TIMEOUT': 5,
+    'LOCK_POLL_INTERVAL': 0.05,
+}
+
+# Seconds a websocket chat membership check is shared between connections
+CHAT_MEMBERSHIP_CACHE_TIMEOUT = 60
+
+# Online roster and typing indicators of chats, in seconds, the roster is kept in the cache
+# and every connection refreshes its entry each HEARTBEAT_INTERVAL, silent ones drop out after TTL
+CHAT_PRESENCE = {
+    'HEARTBEAT_INTERVAL': 15,
+    'TTL': 45,
+    'TYPING_INTERVAL': 3,
+}
+
+# Frames a multiplexed inbox socket may fall behind before it is disconnected
+CHAT_INBOX = {
+    'OUTBOUND_QUEUE_SIZE': 256,
+}
+
+# Seconds the outcome of an order create sent with an Idempotency-Key header,
+# or of a websocket message sent with a client_id, is replayed to retries
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+# Upper bounds of the price buckets counted by ?facets=1 on the order list, the last bucket is open
+ORDER_PRICE_BUCKETS = [100, 500, 1000, 5000, 10000]
+
+# Bulk order import validates and inserts IMPORT_CHUNK_SIZE rows per transaction,
+# export reads EXPORT_CHUNK_SIZE rows per round-trip of its server-side cursor
+ORDER_BULK = {
+    'IMPORT_CHUNK_SIZE': 500,
+    'IMPORT_MAX_ROWS': int(os.getenv('ORDER_IMPORT_MAX_ROWS', 10000)),
+    'EXPORT_CHUNK_SIZE': 2000,
+}
+
+# Messages fetched per round-trip of the server-side cursor of a chat transcript export
+CHAT_TRANSCRIPT = {
+    'CHUNK_SIZE': 2000,
+}
+
+# Text search configuration of Order.search_vector, 'simple' keeps non-English titles searchable
+ORDER_SEARCH_CONFIG = 'simple'
+
+# Chat messages are written in batches, 'ack' broadcasts a message after it is committed,
+# 'fire_and_forget' broadcasts it immediately (without an id) and persists it in the background
+CHAT_MESSAGE_BUFFER = {
+    'MAX_SIZE': int(os.getenv('CHAT_BUFFER_MAX_SIZE', 100)),
+    'FLUSH_INTERVAL': float(os.getenv('CHAT_BUFFER_FLUSH_INTERVAL', 0.05)),
+    'DURABILITY': os.getenv('CHAT_BUFFER_DURABILITY', 'ack'),
+}
+
+# Downscaled WebP variants of order images are rendered by a spawned process pool,
+# 'inline' renders them in the request thread (tests)
+IMAGE_PIPELINE = {
+    'EXECUTOR': os.getenv('IMAGE_PIPELINE_EXECUTOR', 'process'),
+    'WORKERS': int(os.getenv('IMAGE_PIPELINE_WORKERS', 2)),
+    'VARIANTS': {
+        'thumbnail': (320, 320),
+        'preview': (1280, 1280),
     },
+    'QUALITY': 80,
 }
 
+# Minutes a stored file has to be left untouched before a released blob is deleted, saving content
+# that is already stored touches the file, so an upload reusing it in the meantime keeps it
+MEDIA_GARBAGE_GRACE_MINUTES = 60
+
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 MEDIA_URL = '/media/'
 
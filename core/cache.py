@@ -0,0 +1,134 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def get_cache():
+    return caches[settings.RESOURCE_CACHE['ALIAS']]
+
+
+def version_keys(resource, identifier):
+    return 'version:%s' % resource, 'version:%s:%s' % (resource, identifier)
+
+
+def get_resource_version(resource):
+    """
+    Version of a whole resource, bumped by invalidate(resource)
+    """
+
+    cache = get_cache()
+    key = 'version:%s' % resource
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        cache.set(key, version, None)
+    return version
+
+
+def get_versions(resource, identifier):
+    """
+    Versions are the times a resource (or one of its entries) was last invalidated,
+    bumping them makes every key built from the old ones unreachable
+    """
+
+    cache = get_cache()
+    keys = version_keys(resource, identifier)
+    versions = cache.get_many(keys)
+    missing = {key: time.time() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return tuple(versions[key] for key in keys)
+
+
+def invalidate(resource, identifier=None):
+    """
+    Bump the version now and again on commit, so entries recomputed from
+    not yet committed state in between are not served afterwards
+    """
+
+    def bump():
+        key = 'version:%s' % resource if identifier is None else 'version:%s:%s' % (resource, identifier)
+        get_cache().set(key, time.time(), None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def get_or_compute(key, compute, timeout):
+    """
+    Read-through lookup, only one worker recomputes a missing key while the others wait for it
+    """
+
+    cache = get_cache()
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = '%s:lock' % key
+    lock_timeout = settings.RESOURCE_CACHE['LOCK_TIMEOUT']
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(settings.RESOURCE_CACHE['LOCK_POLL_INTERVAL'])
+        value = cache.get(key)
+        if value is not None:
+            return value
+    return compute()
+
+
+class CachedResponseMixin:
+    """
+    Serves list/retrieve from the resource cache and answers conditional requests with 304
+    """
+
+    cache_resource = None
+
+    def get_cache_identifier(self):
+        return self.kwargs.get(self.lookup_url_kwarg or self.lookup_field, 'list')
+
+    def list(self, request, *args, **kwargs):
+        render = super().list
+        return self.cached_response(request, lambda: render(request, *args, **kwargs).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        render = super().retrieve
+        return self.cached_response(request, lambda: render(request, *args, **kwargs).data)
+
+    def cached_response(self, request, render):
+        identifier = self.get_cache_identifier()
+        versions = get_versions(self.cache_resource, identifier)
+        key = 'resource:%s:%s:%s:%s' % (
+            self.cache_resource,
+            identifier,
+            ':'.join(map(repr, versions)),
+            hashlib.md5(request.get_full_path().encode()).hexdigest(),
+        )
+
+        def compute():
+            data = render()
+            etag = '"%s"' % hashlib.md5(json.dumps(data, cls=JSONEncoder).encode()).hexdigest()
+            return {'data': data, 'etag': etag, 'last_modified': int(max(versions))}
+
+        entry = get_or_compute(key, compute, settings.RESOURCE_CACHE['TIMEOUT'])
+        headers = {'ETag': entry['etag'], 'Last-Modified': http_date(entry['last_modified'])}
+        not_modified = get_conditional_response(request, etag=entry['etag'], last_modified=entry['last_modified'])
+        response = not_modified if not_modified is not None else Response(entry['data'])
+        for header, value in headers.items():
+            response[header] = value
+        return response
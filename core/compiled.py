@@ -0,0 +1,163 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.response import Response
+
+# fields whose to_representation returns the database value unchanged
+IDENTITY_FIELDS = {
+    serializers.IntegerField,
+    serializers.CharField,
+    serializers.EmailField,
+    serializers.SlugField,
+    serializers.URLField,
+    serializers.BooleanField,
+    serializers.NullBooleanField,
+    serializers.ReadOnlyField,
+}
+
+# fields whose to_representation depends on nothing but the value and the settings,
+# floats and decimals are left to DRF so rendered numbers cannot change
+CONVERTED_FIELDS = {
+    serializers.DateTimeField,
+    serializers.DateField,
+    serializers.TimeField,
+    serializers.ChoiceField,
+    serializers.UUIDField,
+}
+
+
+class NotCompilable(Exception):
+    pass
+
+
+class CompiledSerializer:
+    """
+    Read path of a ModelSerializer without the DRF field machinery
+    Every rendered value is selected as one column of a flat values() projection,
+    nested serializers of forward foreign keys are joined instead of loaded as instances,
+    and each row is folded back into the dicts the serializer would return
+    with the keys and converters resolved once per serializer class
+    Sources that are not model fields must be annotations of the serialized queryset
+    """
+
+    def __init__(self, serializer_class):
+        serializer = serializer_class()
+        self.model = serializer.Meta.model
+        self.annotations = set()
+        paths = []
+        self.build = _compile(serializer, self.model, '', paths, self.annotations)
+        self.paths = tuple(dict.fromkeys(paths))
+
+    def supports(self, queryset) -> bool:
+        return queryset.model is self.model and self.annotations <= set(queryset.query.annotations)
+
+    def project(self, queryset, *extra):
+        """
+        extra columns are selected but not rendered, e.g. the ones a paginator builds cursors from
+        """
+
+        return queryset.values(*dict.fromkeys(self.paths + extra))
+
+    def serialize(self, rows) -> list:
+        build = self.build
+        return [build(row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def compiled_for(serializer_class):
+    """
+    Compiled form of a serializer class, None when one of its fields needs DRF to render it
+    """
+
+    try:
+        return CompiledSerializer(serializer_class)
+    except NotCompilable:
+        return None
+
+
+def _compile(serializer, model, prefix, paths, annotations):
+    if type(serializer).to_representation is not serializers.Serializer.to_representation:
+        raise NotCompilable(prefix or serializer)
+
+    steps = []
+    for field_name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if field.source == '*' or len(field.source_attrs) != 1:
+            raise NotCompilable(prefix + field_name)
+        lookup = prefix + field.source
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            model_field = None
+
+        if isinstance(field, serializers.ModelSerializer):
+            if model_field is None or not model_field.concrete or not model_field.many_to_one and not model_field.one_to_one:
+                raise NotCompilable(lookup)
+            # the foreign key column tells an empty relation (rendered as None) from a joined row
+            paths.append(lookup)
+            nested = _compile(field, model_field.related_model, lookup + '__', paths, annotations)
+            steps.append((field_name, lookup, None, nested))
+            continue
+
+        if model_field is None:
+            if prefix:
+                # annotations only exist on the serialized queryset, not on the joined models
+                raise NotCompilable(lookup)
+            annotations.add(lookup)
+        elif model_field.is_relation:
+            forward = model_field.concrete and (model_field.many_to_one or model_field.one_to_one)
+            if not (forward and type(field) is serializers.PrimaryKeyRelatedField and field.pk_field is None):
+                raise NotCompilable(lookup)
+        paths.append(lookup)
+        steps.append((field_name, lookup, _converter(field, lookup), None))
+
+    def build(row):
+        data = {}
+        for key, path, convert, nested in steps:
+            value = row[path]
+            if value is None:
+                data[key] = None
+            elif nested is not None:
+                data[key] = nested(row)
+            elif convert is None:
+                data[key] = value
+            else:
+                data[key] = convert(value)
+        return data
+
+    return build
+
+
+def _converter(field, lookup):
+    if type(field) in IDENTITY_FIELDS or type(field) is serializers.PrimaryKeyRelatedField:
+        return None
+    if type(field) in CONVERTED_FIELDS:
+        return field.to_representation
+    raise NotCompilable(lookup)
+
+
+class CompiledListMixin:
+    """
+    Renders list pages through the compiled form of the action's serializer,
+    serializers that cannot be compiled and querysets missing an annotation
+    they read are rendered by DRF as before
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.paginated_response(self.filter_queryset(self.get_queryset()))
+
+    def paginated_response(self, queryset, serializer_class=None):
+        compiled = compiled_for(serializer_class or self.get_serializer_class())
+        if compiled is None or not compiled.supports(queryset):
+            page = self.paginate_queryset(queryset)
+            if page is None:
+                return Response(self.get_serializer(queryset, many=True).data)
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        rows = compiled.project(queryset, *getattr(self.paginator, 'cursor_fields', ()))
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response(compiled.serialize(rows))
+        return self.get_paginated_response(compiled.serialize(page))
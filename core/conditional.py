@@ -0,0 +1,48 @@
+import calendar
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from core.cache import get_resource_version
+
+
+def changes_stamp(queryset):
+    """
+    Max updated_at and row count of a queryset, together they change whenever
+    a row is added, removed or saved
+    The rows are selected by pk, so annotations of the queryset are neither computed
+    nor grouped by in the aggregate
+    """
+
+    rows = queryset.model._base_manager.filter(pk__in=queryset.order_by().values('pk'))
+    stamp = rows.aggregate(last_modified=Max('updated_at'), count=Count('pk'))
+    return stamp['last_modified'], stamp['count']
+
+
+class ConditionalGetMixin:
+    """
+    Answers If-None-Match/If-Modified-Since with 304 before anything is fetched or serialized
+    Rows rendered from related models that have no updated_at (category and user names)
+    are covered by the cache versions of stamp_resources, bumped when those models are saved
+    """
+
+    stamp_resources = ()
+
+    def conditional_response(self, request, querysets, render):
+        stamps = [changes_stamp(queryset) for queryset in querysets]
+        versions = [get_resource_version(resource) for resource in self.stamp_resources]
+        modified = [calendar.timegm(last_modified.utctimetuple()) for last_modified, _ in stamps if last_modified]
+        modified += [int(version) for version in versions]
+        last_modified = max(modified) if modified else None
+        etag = 'W/"%s"' % hashlib.md5(repr((request.get_full_path(), stamps, versions)).encode()).hexdigest()
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = render()
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_vary_headers(response, ('Authorization',))
+        return response
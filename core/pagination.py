@@ -0,0 +1,173 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Seek pagination over (created_at, id), no OFFSET scans and no COUNT(*)
+    ?before=<cursor> walks towards older rows (newest first),
+    ?after=<cursor> returns rows newer than the cursor (oldest first),
+    which lets a client catch up on what it missed after a reconnect
+    Keyset pages are opt-in, an empty ?before= asks for the newest page; requests
+    without either parameter and querysets explicitly ordered by other fields
+    are paginated by fallback_class, so ?page= and count keep working
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    before_query_param = 'before'
+    after_query_param = 'after'
+    keyset_fields = ('created_at', 'id', 'pk')
+    # columns a page of values() rows must select to build cursors from
+    cursor_fields = ('created_at', 'id')
+    fallback_class = PageNumberPagination
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fallback = None
+        if not self.is_keyset_requested(request) or not self.is_keyset_ordered(queryset):
+            self.fallback = self.fallback_class()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.base_url = request.build_absolute_uri()
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        self.newer = after is not None
+        if self.newer:
+            queryset = queryset.filter(self.seek(after, 'gt')).order_by('created_at', 'id')
+        else:
+            if before is not None:
+                queryset = queryset.filter(self.seek(before, 'lt'))
+            queryset = queryset.order_by('-created_at', '-id')
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        param = self.after_query_param if self.newer else self.before_query_param
+        return self.build_link(param, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.page:
+            return None
+        param = self.before_query_param if self.newer else self.after_query_param
+        return self.build_link(param, self.page[0])
+
+    def build_link(self, param, row):
+        url = remove_query_param(self.base_url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, self.encode_cursor(row))
+
+    def is_keyset_requested(self, request):
+        return self.before_query_param in request.query_params or self.after_query_param in request.query_params
+
+    def is_keyset_ordered(self, queryset):
+        return all(
+            isinstance(field, str) and field.lstrip('-') in self.keyset_fields
+            for field in queryset.query.order_by
+        )
+
+    @staticmethod
+    def seek(cursor, lookup):
+        created_at, pk = cursor
+        return Q(**{'created_at__%s' % lookup: created_at}) | Q(created_at=created_at, **{'id__%s' % lookup: pk})
+
+    @staticmethod
+    def encode_cursor(row):
+        created_at, pk = (row['created_at'], row['id']) if isinstance(row, dict) else (row.created_at, row.pk)
+        value = '%s|%s' % (created_at.isoformat(), pk)
+        return urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            created_at, pk = urlsafe_b64decode(encoded.encode()).decode().split('|')
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+
+class OrderingKeysetPagination(KeysetPagination):
+    """
+    Seek pagination over (<first ordering field>, pk) for any ordering of the queryset,
+    fields may be annotations, e.g. counters joined from another table
+    Pages are only walked forward with ?before=, the cursor carries the ordering
+    value of the last row so ?ordering= must not change between pages
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fallback = None
+        self.newer = False
+        self.base_url = request.build_absolute_uri()
+        ordering = next(iter(queryset.query.order_by), '-pk')
+        if not isinstance(ordering, str):
+            self.fallback = self.fallback_class()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.field = ordering.lstrip('-')
+        descending = ordering.startswith('-')
+        cursor = self.decode_cursor(
+            request.query_params.get(self.before_query_param), self.output_field(queryset, self.field))
+        if cursor is not None:
+            value, pk = cursor
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{'%s__%s' % (self.field, lookup): value}) | Q(**{self.field: value, 'pk__%s' % lookup: pk}))
+        queryset = queryset.order_by(ordering, '-pk' if descending else 'pk')
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_previous_link(self):
+        return None
+
+    @staticmethod
+    def output_field(queryset, name):
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        if name == 'pk':
+            return queryset.model._meta.pk
+        return queryset.model._meta.get_field(name)
+
+    def encode_cursor(self, row):
+        value = getattr(row, self.field)
+        value = '%s|%s' % (value.isoformat() if hasattr(value, 'isoformat') else value, row.pk)
+        return urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, encoded, field=None):
+        if not encoded:
+            return None
+        try:
+            value, pk = urlsafe_b64decode(encoded.encode()).decode().rsplit('|', 1)
+            return field.to_python(value), int(pk)
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
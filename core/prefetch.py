@@ -0,0 +1,126 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+class QueryPlan:
+    """
+    select_related/prefetch_related/only() needed to serialize a model without N+1 queries
+    Sources that are not model fields (method fields, properties) are collected in unknown,
+    only() is skipped unless all of them are annotations of the queryset being planned
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.select_related = []
+        self.prefetch_related = []
+        self.only = {'pk'}
+        self.unknown = set()
+
+    def apply(self, queryset):
+        if queryset.model is not self.model:
+            return queryset
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*(
+                Prefetch(lookup, queryset=child_plan.apply(child_plan.model._default_manager.all()))
+                if child_plan else lookup
+                for lookup, child_plan in self.prefetch_related
+            ))
+        if not self.unknown - set(queryset.query.annotations):
+            queryset = queryset.only(*self.only)
+        return queryset
+
+    def add_select_related(self, lookup):
+        if lookup not in self.select_related:
+            self.select_related.append(lookup)
+
+
+@lru_cache(maxsize=None)
+def plan_for(serializer_class) -> QueryPlan:
+    model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+    plan = QueryPlan(model)
+    if model is not None:
+        _walk(plan, serializer_class(), model, '')
+    return plan
+
+
+def _walk(plan, serializer, model, prefix):
+    for field_name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if field.source == '*':
+            if isinstance(field, serializers.ModelSerializer):
+                _walk(plan, field, model, prefix)
+            else:
+                plan.unknown.add(prefix + field_name)
+            continue
+        _walk_source(plan, field, model, prefix)
+
+
+def _walk_source(plan, field, model, prefix):
+    attrs = field.source_attrs
+    for position, attr in enumerate(attrs):
+        lookup = prefix + attr
+        last = position == len(attrs) - 1
+        try:
+            model_field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            plan.unknown.add(lookup)
+            return
+
+        if not model_field.is_relation:
+            if last:
+                plan.only.add(lookup)
+            else:
+                plan.unknown.add(lookup)
+            return
+
+        if model_field.one_to_many or model_field.many_to_many:
+            plan.prefetch_related.append((lookup, _child_plan(field, model_field, last)))
+            return
+
+        if not model_field.concrete:
+            # reverse one-to-one, the row to load is not known up front
+            plan.unknown.add(lookup)
+            return
+
+        plan.only.add(lookup)
+        if last and isinstance(field, serializers.PrimaryKeyRelatedField):
+            return
+        plan.add_select_related(lookup)
+        model = model_field.related_model
+        prefix = lookup + '__'
+        if last:
+            if isinstance(field, serializers.ModelSerializer):
+                _walk(plan, field, model, prefix)
+            else:
+                plan.unknown.add(lookup)
+
+
+def _child_plan(field, model_field, last):
+    child = getattr(field, 'child', None)
+    if not (last and model_field.one_to_many and isinstance(child, serializers.ModelSerializer)):
+        return None
+    child_plan = QueryPlan(model_field.related_model)
+    _walk(child_plan, child, model_field.related_model, '')
+    child_plan.only.add(model_field.field.name)
+    return child_plan
+
+
+class QueryPlanMixin:
+    """
+    Applies the query plan of the action's serializer to querysets of read requests
+    """
+
+    def get_queryset(self):
+        return self.plan_queryset(super().get_queryset())
+
+    def plan_queryset(self, queryset, serializer_class=None):
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        return plan_for(serializer_class or self.get_serializer_class()).apply(queryset)
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every file once under the sha256 digest of its content
+    The digest is computed while the upload is streamed to a temporary file,
+    saving content that is already stored only touches the existing blob
+    """
+
+    blob_directory = 'blobs'
+    temp_directory = 'tmp'
+
+    def get_available_name(self, name, max_length=None):
+        # the final name is derived from the content in _save
+        return name
+
+    def _save(self, name, content):
+        temp_directory = self.path(self.temp_directory)
+        os.makedirs(temp_directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_directory)
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+
+            name = self.blob_name(digest.hexdigest(), posixpath.splitext(name)[1].lower())
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                # a fresh mtime keeps the garbage collector away from a blob that is being reused
+                os.utime(full_path)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.replace(temp_path, full_path)
+                temp_path = None
+                if self.file_permissions_mode is not None:
+                    os.chmod(full_path, self.file_permissions_mode)
+        finally:
+            if temp_path is not None:
+                os.remove(temp_path)
+        return name
+
+    def blob_name(self, hexdigest, extension):
+        return posixpath.join(self.blob_directory, hexdigest[:2], hexdigest[2:4], hexdigest + extension)